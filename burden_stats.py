@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# Burden statistics of samples drawn on a burden map, computed from a summed-area table
+# so that the cost does not depend on the size of the sliding window. Shared by
+# integrate_density_over_samples.py and histo-burden/wildcat_run.py, so that both
+# compute the same statistic
+import numpy as np
+
+# Integral image (summed-area table) of a 2D array, with a leading row and column of
+# zeros, so that the sum of img[x0:x1,y0:y1] is S[x1,y1] - S[x0,y1] - S[x1,y0] + S[x0,y0]
+def integral_image(img):
+    S = np.zeros((img.shape[0] + 1, img.shape[1] + 1))
+    np.cumsum(img, axis=0, out=S[1:,1:])
+    np.cumsum(S[1:,1:], axis=1, out=S[1:,1:])
+    return S
+
+# Sums of img over the boxes [x0:x1,y0:y1] for all combinations of the entries of the
+# coordinate vectors (x0,x1) and (y0,y1), using the integral image
+def box_sums(S, x0, x1, y0, y1):
+    return S[np.ix_(x1,y1)] - S[np.ix_(x0,y1)] - S[np.ix_(x1,y0)] + S[np.ix_(x0,y0)]
+
+# Mean burden over the ROI [nx:nx+nw,ny:ny+nh] and the maximum over the ROI of the mean
+# burden in a fx by fy sliding window. As with scipy.signal.convolve(..., mode='same'),
+# the window at i spans [i-fx//2, i+(fx-1)//2], and it is clipped to the ROI and
+# normalized by the number of pixels it covers
+def roi_burden(S, nx, ny, nw, nh, fx, fy):
+    x_end, y_end = min(nx + nw, S.shape[0] - 1), min(ny + nh, S.shape[1] - 1)
+    if x_end <= nx or y_end <= ny:
+        return np.nan, np.nan
+    burden = box_sums(S, [nx], [x_end], [ny], [y_end])[0,0] / ((x_end - nx) * (y_end - ny))
+
+    i, j = np.arange(nx, x_end), np.arange(ny, y_end)
+    x0, x1 = np.maximum(i - fx // 2, nx), np.minimum(i + (fx - 1) // 2 + 1, x_end)
+    y0, y1 = np.maximum(j - fy // 2, ny), np.minimum(j + (fy - 1) // 2 + 1, y_end)
+    counts = np.outer(x1 - x0, y1 - y0)
+    max_sliding = np.amax(box_sums(S, x0, x1, y0, y1) / counts)
+    return burden, max_sliding
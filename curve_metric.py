@@ -6,8 +6,7 @@ from skimage import measure
 import skimage.filters as flt
 import skimage.morphology as morph
 import scipy.interpolate as interp
-import similaritymeasures as sim
-import scipy.spatial.distance as sdist
+import scipy.spatial
 import scipy.stats
 import json
 import sys
@@ -16,6 +15,60 @@ import svgwrite
 def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
+# Distance from each point of curve A to the nearest point of curve B and vice versa,
+# using a k-d tree on each curve rather than the full distance matrix
+def boundary_distances(A, B):
+    dA, _ = scipy.spatial.cKDTree(B).query(A)
+    dB, _ = scipy.spatial.cKDTree(A).query(B)
+    return dA, dB
+
+# Number of points at the start and end of curve A that are closest to an endpoint of
+# curve B (i.e., the distance to the endpoint equals the nearest neighbor distance dA).
+# Returns the range [a, b] of points of A to keep
+def trim_range(A, B, dA):
+    near = np.logical_or(np.isclose(np.linalg.norm(A - B[0], axis=1), dA, rtol=1e-9, atol=0),
+                         np.isclose(np.linalg.norm(A - B[-1], axis=1), dA, rtol=1e-9, atol=0))
+    a, b = 0, len(A) - 1
+    while a < b and near[a]:
+        a = a + 1
+    while b > a and near[b]:
+        b = b - 1
+    return a, b
+
+# Discrete Frechet distance between curves P and Q. The coupling distance matrix is
+# filled one anti-diagonal at a time, since each cell only depends on cells in the two
+# previous anti-diagonals. This takes O(N+M) memory instead of O(N*M), and each
+# anti-diagonal is computed with vector operations
+def frechet_distance(P, Q):
+    n, m = len(P), len(Q)
+    prev, prev2 = np.zeros(0), np.zeros(0)
+    (p0, p1), (q0, q1) = (0, -1), (0, -1)
+    for k in range(n + m - 1):
+
+        # Cells (i, k-i) on this anti-diagonal
+        i0, i1 = max(0, k - m + 1), min(n - 1, k)
+        i = np.arange(i0, i1 + 1)
+        d = np.sqrt(np.sum((P[i] - Q[k - i]) ** 2, axis=1))
+
+        if k == 0:
+            cur = d
+        else:
+            # Best of the cells (i-1,j) and (i,j-1) on the previous anti-diagonal, which
+            # spans i in [p0,p1], and (i-1,j-1) on the one before, which spans [q0,q1]
+            best = np.full(len(i), np.inf)
+            ok = i - 1 >= p0
+            best[ok] = prev[i[ok] - 1 - p0]
+            ok = i <= p1
+            best[ok] = np.minimum(best[ok], prev[i[ok] - p0])
+            ok = np.logical_and(i - 1 >= q0, i - 1 <= q1)
+            best[ok] = np.minimum(best[ok], prev2[i[ok] - 1 - q0])
+            cur = np.maximum(best, d)
+
+        prev2, (q0, q1) = prev, (p0, p1)
+        prev, (p0, p1) = cur, (i0, i1)
+
+    return cur[-1]
+
 if __name__ == "__main__":
 
     if len(sys.argv) < 5:
@@ -67,32 +120,19 @@ if __name__ == "__main__":
     Ym=nii_mri.affine[:2, :2].dot(Xm.transpose()).transpose()+nii_mri.affine[:2, 3]
     Yh=nii_hist.affine[:2, :2].dot(Xh.transpose()).transpose()+nii_hist.affine[:2, 3]
 
-    # Compute pointwise distance matrix
-    D=sdist.cdist(Ym,Yh)
-    dh,dm = np.amin(D,0), np.amin(D,1)
+    # Compute pointwise nearest neighbor distances
+    dm,dh = boundary_distances(Ym, Yh)
 
     # From the end of each curve, trim the points that match to the end of the other curve
-    am,bm,ah,bh = 0,len(Ym)-1,0,len(Yh)-1
-
-    while am < bm and (D[am, 0] == dm[am] or D[am,len(Yh)-1] == dm[am]):
-        am = am + 1
-
-    while bm > am and (D[bm, 0] == dm[bm] or D[bm, len(Yh) - 1] == dm[bm]):
-        bm = bm - 1
-
-    while ah < bh and (D[0, ah] == dh[ah] or D[len(Ym) - 1, ah] == dh[ah]):
-        ah = ah + 1
-
-    while bh > ah and (D[0, bh] == dh[bh] or D[len(Ym) - 1, bh] == dh[bh]):
-        bh = bh - 1
+    am,bm = trim_range(Ym, Yh, dm)
+    ah,bh = trim_range(Yh, Ym, dh)
 
     print("Clipping MRI by %d and %d, Histo by %d and %d points" % (am, len(Ym)-bm, ah, len(Yh)-bh))
 
     # Extract just the subcurves
     Ym_clip = Ym[range(am,bm+1),:]
     Yh_clip = Yh[range(ah,bh+1),:]
-    D=sdist.cdist(Ym_clip,Yh_clip)
-    dh,dm = np.amin(D,0), np.amin(D,1)
+    dm,dh = boundary_distances(Ym_clip, Yh_clip)
 
     # Compute some standard metrics
     mtx = {
@@ -102,7 +142,7 @@ if __name__ == "__main__":
         "bde_rms": np.sqrt(np.mean((np.mean(dh**2), np.mean(dm**2)))),
         "bde_hd95": np.mean((np.quantile(dh, 0.95), np.quantile(dm, 0.95))),
         "bde_hd": np.max((np.max(dh), np.max(dm))),
-        "frechet" : sim.frechet_dist(Ym, Yh)
+        "frechet" : frechet_distance(Ym, Yh)
     }
 
     # Print the json
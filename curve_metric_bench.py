@@ -0,0 +1,91 @@
+import numpy as np
+import scipy.spatial.distance as sdist
+import similaritymeasures as sim
+import argparse
+import tracemalloc
+import time
+from curve_metric import boundary_distances, trim_range, frechet_distance
+
+# Compare the time and peak memory of the boundary distances and Frechet distance in
+# curve_metric.py with the previous implementation (full distance matrices and
+# similaritymeasures.frechet_dist) on long synthetic contours
+
+# Two noisy, slightly shifted open contours with n and m points
+def synthetic_contours(n, m, seed=0):
+    rng = np.random.RandomState(seed)
+    t1, t2 = np.linspace(0, 1.5 * np.pi, n), np.linspace(0.1, 1.6 * np.pi, m)
+    A = np.stack((np.cos(t1), np.sin(t1)), axis=1) * 10 + rng.normal(0, 0.05, (n, 2))
+    B = np.stack((np.cos(t2), np.sin(t2)), axis=1) * 10.3 + rng.normal(0, 0.05, (m, 2)) + 0.2
+    return A, B
+
+# Run a function, returning its result, the time it took and its peak memory in MB
+def measure(fn, *args):
+    tracemalloc.start()
+    t0 = time.time()
+    result = fn(*args)
+    t1 = time.time()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, t1 - t0, peak / 2.0**20
+
+# Boundary distances and trimming from the full distance matrix, as done previously
+def distances_matrix(Ym, Yh):
+    D=sdist.cdist(Ym,Yh)
+    dh,dm = np.amin(D,0), np.amin(D,1)
+    am,bm,ah,bh = 0,len(Ym)-1,0,len(Yh)-1
+    while am < bm and (D[am, 0] == dm[am] or D[am,len(Yh)-1] == dm[am]):
+        am = am + 1
+    while bm > am and (D[bm, 0] == dm[bm] or D[bm, len(Yh) - 1] == dm[bm]):
+        bm = bm - 1
+    while ah < bh and (D[0, ah] == dh[ah] or D[len(Ym) - 1, ah] == dh[ah]):
+        ah = ah + 1
+    while bh > ah and (D[0, bh] == dh[bh] or D[len(Ym) - 1, bh] == dh[bh]):
+        bh = bh - 1
+    return dm, dh, (am, bm, ah, bh)
+
+# The same with k-d trees, as done in curve_metric.py
+def distances_tree(Ym, Yh):
+    dm, dh = boundary_distances(Ym, Yh)
+    return dm, dh, trim_range(Ym, Yh, dm) + trim_range(Yh, Ym, dh)
+
+# Check frechet_distance against similaritymeasures.frechet_dist on small random
+# curves, including curves with a single point. Raises an exception on a mismatch
+def check_frechet(n_trials=200, max_points=12, seed=0):
+    rng = np.random.RandomState(seed)
+    sizes = [(1, 1), (1, max_points), (max_points, 1)]
+    sizes += [tuple(rng.randint(1, max_points + 1, 2)) for t in range(n_trials)]
+    for (n, m) in sizes:
+        P, Q = rng.rand(n, 2), rng.rand(m, 2)
+        f0, f1 = sim.frechet_dist(P, Q), frechet_distance(P, Q)
+        if not np.isclose(f0, f1, rtol=1e-9, atol=1e-12):
+            raise Exception('Frechet distance mismatch for %dx%d curves: %g vs %g' % (n, m, f0, f1))
+    print('Frechet distance matches similaritymeasures on %d random curve pairs' % (len(sizes),))
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Benchmark the metrics in curve_metric.py')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 4000, 16000],
+                        help='Number of points in the contours')
+    parser.add_argument('--skip-old-frechet', type=int, default=8000,
+                        help='Do not run similaritymeasures.frechet_dist on contours longer than this')
+    args = parser.parse_args()
+
+    check_frechet()
+
+    print('%8s %-10s %10s %12s %10s %12s %12s' %
+          ('points', 'metric', 'old (s)', 'old (MB)', 'new (s)', 'new (MB)', 'max diff'))
+    for n in args.sizes:
+        Ym, Yh = synthetic_contours(n, int(n * 1.1))
+
+        (dm0, dh0, trim0), t0, m0 = measure(distances_matrix, Ym, Yh)
+        (dm1, dh1, trim1), t1, m1 = measure(distances_tree, Ym, Yh)
+        diff = max(np.max(np.abs(dm0 - dm1)), np.max(np.abs(dh0 - dh1)))
+        print('%8d %-10s %10.3f %12.1f %10.3f %12.1f %12.3g %s' %
+              (n, 'distances', t0, m0, t1, m1, diff, '' if trim0 == trim1 else 'trim differs'))
+
+        f1, t1, m1 = measure(frechet_distance, Ym, Yh)
+        if n <= args.skip_old_frechet:
+            f0, t0, m0 = measure(sim.frechet_dist, Ym, Yh)
+            print('%8d %-10s %10.3f %12.1f %10.3f %12.1f %12.3g' % (n, 'frechet', t0, m0, t1, m1, abs(f0 - f1)))
+        else:
+            print('%8d %-10s %10s %12s %10.3f %12.1f %12s' % (n, 'frechet', '-', '-', t1, m1, '-'))
@@ -0,0 +1,125 @@
+# Access to regions of density maps (*_densitymap.nii.gz) without decompressing the
+# whole map. On first use, a map is decompressed into an uncompressed NIfTI file in a
+# cache directory, which is then memory-mapped, so reading a box only touches the
+# bytes in that box. The cache has a size cap, and the least recently used maps are
+# evicted first. Several processes can share the cache directory: an open map holds its
+# own mapping of the file, which stays readable if another process evicts the file
+import numpy as np
+import os
+import gzip
+import shutil
+import hashlib
+import nibabel as nib
+
+# Open a cache in the given directory, creating it if needed
+def open_density_cache(cache_dir, max_size_gb=20.0):
+    os.makedirs(cache_dir, exist_ok=True)
+    return {'dir': cache_dir, 'max_bytes': int(max_size_gb * 2**30)}
+
+# Name of the cached copy of a map, from its path, size and modification time, so
+# that a map that is regenerated is converted again
+def cache_key(fn):
+    st = os.stat(fn)
+    ident = '%s:%d:%f' % (os.path.abspath(fn), st.st_size, st.st_mtime)
+    return hashlib.sha1(ident.encode()).hexdigest() + '.nii'
+
+# Check if a temporary file left by a decompression (named <key>.<pid>.tmp) belongs to
+# a process that no longer exists, i.e., the decompression crashed
+def is_stale_tmp(fn):
+    try:
+        os.kill(int(fn.split('.')[-2]), 0)
+    except (ValueError, IndexError, ProcessLookupError):
+        return True
+    except PermissionError:
+        pass
+    return False
+
+# Remove the least recently used maps until the cache is within its size cap. The
+# modification time of a cached map records when it was last used. Temporary files of
+# crashed decompressions are removed as well
+def evict(cache, keep):
+    entries = []
+    for fn in os.listdir(cache['dir']):
+        if fn.endswith('.tmp') and is_stale_tmp(fn):
+            try:
+                os.remove(os.path.join(cache['dir'], fn))
+            except OSError:
+                pass
+        elif fn.endswith('.nii') and fn != keep:
+            try:
+                st = os.stat(os.path.join(cache['dir'], fn))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, fn))
+    try:
+        total = sum(e[1] for e in entries) + os.path.getsize(os.path.join(cache['dir'], keep))
+    except OSError:
+        return
+    for (_, size, fn) in sorted(entries):
+        if total <= cache['max_bytes']:
+            break
+        try:
+            os.remove(os.path.join(cache['dir'], fn))
+        except OSError:
+            pass
+        total -= size
+
+# Get the path of an uncompressed copy of a map, decompressing it into the cache if
+# needed (including when another process evicts it while it is being looked up).
+# Uncompressed maps are used in place
+def cached_density_path(cache, fn):
+    if not fn.endswith('.gz'):
+        return fn
+    key = cache_key(fn)
+    fn_cached = os.path.join(cache['dir'], key)
+    try:
+        os.utime(fn_cached)
+        return fn_cached
+    except FileNotFoundError:
+        pass
+
+    # Decompress in a stream to a temporary file, renamed into place when complete
+    fn_tmp = '%s.%d.tmp' % (fn_cached, os.getpid())
+    try:
+        with gzip.open(fn, 'rb') as f_in, open(fn_tmp, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out, 16 * 1048576)
+        os.replace(fn_tmp, fn_cached)
+    except:
+        if os.path.exists(fn_tmp):
+            os.remove(fn_tmp)
+        raise
+    evict(cache, key)
+    return fn_cached
+
+# Open a density map through the cache. The image data is memory-mapped here, once,
+# since nibabel would reopen the file on every slice and fail if it had been evicted.
+# If another process evicts the map before it is mapped, it is decompressed again
+def open_density_map(cache, fn):
+    for attempt in range(3):
+        fn_map = cached_density_path(cache, fn)
+        try:
+            hdr = nib.load(fn_map).header
+            data = np.memmap(fn_map, dtype=hdr.get_data_dtype(), mode='r', offset=int(hdr.get_data_offset()),
+                             shape=hdr.get_data_shape(), order='F')
+        except FileNotFoundError:
+            continue
+        (slope, inter) = hdr.get_slope_inter()
+        return {'path': fn_map, 'cached': fn_map != fn, 'data': data, 'shape': data.shape,
+                'slope': slope, 'inter': inter}
+    raise Exception('Density map %s was evicted from the cache while being opened' % (fn,))
+
+# Read the box [x:x+w,y:y+h] (in voxels) of all the components of a density map,
+# stored as x,y,1,1,components, as a float64 array. The box is clipped to the map.
+# Each read marks a cached map as recently used
+def read_density_region(dmap, x, y, w, h):
+    if dmap['cached']:
+        try:
+            os.utime(dmap['path'])
+        except OSError:
+            pass
+    roi = np.array(dmap['data'][x:x+w, y:y+h, 0, 0, :], dtype=np.float64)
+    if dmap['slope'] is not None and dmap['slope'] != 1.0 and dmap['slope'] != 0.0:
+        roi *= dmap['slope']
+    if dmap['inter'] is not None and dmap['inter'] != 0.0:
+        roi += dmap['inter']
+    return roi
@@ -0,0 +1,174 @@
+#!/bin/python
+# Multi-resolution density maps. A density map is stored as an OME-Zarr style store
+# (multiscales metadata, version 0.4) holding a CxYxX array for each level, each level
+# half the size of the previous one. Consumers can read just the level and the region
+# they need instead of loading and resampling the full map. Also converts between
+# this format and the 2-component NIfTI images written by wildcat_run.py
+from __future__ import print_function
+import os
+import sys
+import argparse
+import numpy as np
+import SimpleITK as sitk
+import zarr
+
+
+# Halve the size of a CxYxX array by averaging 2x2 blocks. Odd sizes are handled by
+# repeating the last row or column
+def downsample2(x):
+    if x.shape[1] % 2:
+        x = np.concatenate((x, x[:,-1:,:]), axis=1)
+    if x.shape[2] % 2:
+        x = np.concatenate((x, x[:,:,-1:]), axis=2)
+    return 0.25 * (x[:,0::2,0::2] + x[:,1::2,0::2] + x[:,0::2,1::2] + x[:,1::2,1::2])
+
+
+# Open a zarr group in the Zarr v2 format, which OME-Zarr 0.4 requires. zarr 3 writes
+# v3 stores unless told otherwise, and zarr 2 has no zarr_format option
+def open_group_v2(filename, mode):
+    if int(zarr.__version__.split('.')[0]) >= 3:
+        return zarr.open_group(filename, mode=mode, zarr_format=2)
+    return zarr.open_group(filename, mode=mode)
+
+
+# Create a float32 array in a group, with the method of the installed zarr version
+def create_level(root, name, shape, chunks):
+    if hasattr(root, 'create_array'):
+        return root.create_array(name, shape=shape, chunks=chunks, dtype='f4')
+    return root.create_dataset(name, shape=shape, chunks=chunks, dtype='f4')
+
+
+# Write a CxYxX density map (which may be memory-mapped) as a multi-resolution store.
+# Spacing and origin are the (x,y) size and position of the level 0 pixel in mm, and
+# direction is the optional 2x2 direction matrix (row-major, as in SimpleITK), kept in
+# the attributes so that a NIfTI map can be restored exactly. Each level is computed
+# from the previous one in strips of rows, so the full map is never held in memory. By
+# default, levels are added until the coarsest one fits in a single chunk
+def write_density_pyramid(filename, data, spacing, n_levels=None, chunk_size=512, origin=(0.0, 0.0),
+                          direction=None):
+    (nc, ny, nx) = data.shape
+    if n_levels is None:
+        n_levels = 1
+        while max(ny, nx) > chunk_size << (n_levels - 1):
+            n_levels += 1
+
+    root = open_group_v2(filename, mode='w')
+    strip = 2 * chunk_size
+    datasets, src = [], data
+    for k in range(n_levels):
+        shape = (nc, (ny + (1 << k) - 1) >> k, (nx + (1 << k) - 1) >> k)
+        level = create_level(root, str(k), shape, (nc, chunk_size, chunk_size))
+
+        # Level 0 is a copy of the input, other levels are reduced from the previous level
+        for y in range(0, shape[1], chunk_size):
+            if k == 0:
+                level[:,y:y+chunk_size,:] = src[:,y:y+chunk_size,:]
+            else:
+                level[:,y:y+chunk_size,:] = downsample2(np.asarray(src[:,2*y:2*y+strip,:], dtype=np.float32))
+        src = level
+
+        # Pixel centers of coarser levels are shifted by half of the pooled block
+        f = float(1 << k)
+        datasets.append({'path': str(k), 'coordinateTransformations': [
+            {'type': 'scale', 'scale': [1.0, spacing[1] * f, spacing[0] * f]},
+            {'type': 'translation', 'translation': [0.0, origin[1] + spacing[1] * (f-1) / 2,
+                                                    origin[0] + spacing[0] * (f-1) / 2]}]})
+
+    root.attrs['multiscales'] = [{
+        'version': '0.4',
+        'name': os.path.basename(filename),
+        'axes': [{'name': 'c', 'type': 'channel'},
+                 {'name': 'y', 'type': 'space', 'unit': 'millimeter'},
+                 {'name': 'x', 'type': 'space', 'unit': 'millimeter'}],
+        'datasets': datasets,
+        'type': 'mean' }]
+    if direction is not None:
+        root.attrs['direction'] = [float(d) for d in direction]
+
+
+# Open a multi-resolution density map. Returns a list of (array, spacing, origin) for
+# each level, with the spacing and origin given as (x,y) in mm. Arrays are read lazily.
+# zarr detects the format of the store when reading
+def open_density_pyramid(filename):
+    root = zarr.open_group(filename, mode='r')
+    levels = []
+    for ds in root.attrs['multiscales'][0]['datasets']:
+        tran = {t['type']: t for t in ds['coordinateTransformations']}
+        scale = tran['scale']['scale']
+        shift = tran['translation']['translation'] if 'translation' in tran else [0.0, 0.0, 0.0]
+        levels.append((root[ds['path']], (scale[2], scale[1]), (shift[2], shift[1])))
+    return levels
+
+
+# Pick the coarsest level whose spacing is no larger than the requested spacing
+# (in mm), so that only a residual resampling is needed
+def choose_density_level(levels, spacing):
+    best = 0
+    for (k, (_, sp, _)) in enumerate(levels):
+        if max(sp) <= spacing * 1.001:
+            best = k
+    return best
+
+
+# Convert a 2-component NIfTI density map to a multi-resolution store
+def nifti_to_pyramid(fn_nifti, fn_pyramid, n_levels=None, chunk_size=512):
+    img = sitk.ReadImage(fn_nifti)
+    (nx, ny), nc = img.GetSize()[0:2], img.GetNumberOfComponentsPerPixel()
+    data = np.moveaxis(sitk.GetArrayViewFromImage(img).reshape(ny, nx, nc), -1, 0)
+    d = img.GetDirection()
+    direction = (d[0], d[1], d[3], d[4]) if len(d) == 9 else d
+    write_density_pyramid(fn_pyramid, data, img.GetSpacing()[0:2], n_levels, chunk_size,
+                          origin=img.GetOrigin()[0:2], direction=direction)
+
+
+# Convert one level of a multi-resolution store to a NIfTI image, as written by wildcat_run.py
+def pyramid_to_nifti(fn_pyramid, fn_nifti, level=0):
+    (arr, spacing, origin) = open_density_pyramid(fn_pyramid)[level]
+    img = sitk.GetImageFromArray(np.moveaxis(arr[...], 0, -1), isVector=True)
+    img.SetSpacing(spacing)
+    img.SetOrigin(origin)
+    direction = zarr.open_group(fn_pyramid, mode='r').attrs.get('direction')
+    if direction is not None:
+        img.SetDirection(direction)
+    sitk.WriteImage(img, fn_nifti)
+
+
+def do_to_pyramid(args):
+    nifti_to_pyramid(args.input, args.output, args.levels, args.chunk)
+
+
+def do_to_nifti(args):
+    pyramid_to_nifti(args.input, args.output, args.level)
+
+
+def do_info(args):
+    for (k, (arr, spacing, origin)) in enumerate(open_density_pyramid(args.input)):
+        print('Level %d: size %s, spacing %gx%gmm, origin %g,%gmm' %
+              ((k, 'x'.join(str(d) for d in arr.shape)) + tuple(spacing) + tuple(origin)))
+
+
+# Create a parser
+parser = argparse.ArgumentParser(description="Multi-resolution density maps")
+subparsers = parser.add_subparsers(help='sub-command help')
+
+to_pyramid_parser = subparsers.add_parser('to-pyramid', help='Convert a NIfTI density map to a multi-resolution store')
+to_pyramid_parser.add_argument('input', help='NIfTI density map')
+to_pyramid_parser.add_argument('output', help='Multi-resolution store (directory, usually *.zarr)')
+to_pyramid_parser.add_argument('--levels', help='Number of levels (by default, until the map fits in one chunk)',
+                               type=int)
+to_pyramid_parser.add_argument('--chunk', help='Size of the chunks', type=int, default=512)
+to_pyramid_parser.set_defaults(func=do_to_pyramid)
+
+to_nifti_parser = subparsers.add_parser('to-nifti', help='Convert a level of a multi-resolution store to NIfTI')
+to_nifti_parser.add_argument('input', help='Multi-resolution store')
+to_nifti_parser.add_argument('output', help='NIfTI density map')
+to_nifti_parser.add_argument('--level', help='Level to convert (0 is full resolution)', type=int, default=0)
+to_nifti_parser.set_defaults(func=do_to_nifti)
+
+info_parser = subparsers.add_parser('info', help='Print the levels of a multi-resolution store')
+info_parser.add_argument('input', help='Multi-resolution store')
+info_parser.set_defaults(func=do_info)
+
+if __name__ == '__main__':
+    args = parser.parse_args()
+    args.func(args)
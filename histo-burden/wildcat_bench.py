@@ -0,0 +1,206 @@
+#!/bin/python
+# Benchmark the throughput of 'wildcat_run.py apply' on a synthetic slide with a
+# randomly initialized network, so that it can run offline and on CPU-only nodes.
+# Each configuration in the matrix of window size, padding, batch size and number
+# of readers is run in its own process, and its throughput, read bandwidth and peak
+# memory are taken from the profile written by apply. Outputs are also compared to
+# the first configuration with the same window size and padding, to catch changes in
+# the density maps. Super-window configurations whose outputs differ from per-window
+# padding by more than the tolerance are flagged, and the benchmark then fails
+from __future__ import print_function
+import os
+import sys
+import csv
+import json
+import argparse
+import itertools
+import subprocess
+import numpy as np
+import torch
+import torch.nn as nn
+from torchvision import models
+import SimpleITK as sitk
+
+# Import wildcat models
+sys.path.append("wildcat.pytorch")
+import wildcat.models
+
+# The synthetic slide generator is shared with histo-preproc/bench_x16.py
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from synthetic_slide import make_synthetic_slide
+
+# Import wildcat mods
+from unet_wildcat import *
+
+
+# Create a network directory with a valid config and random weights
+def make_random_network(netdir, window_size_raw, padding_size_rel, seed=0):
+    os.makedirs(netdir, exist_ok=True)
+    torch.manual_seed(seed)
+    config = {
+        'resnet': {'size': 18, 'num_classes': 2},
+        'wildcat_upsample': {'kmax': 0.02, 'alpha': 0.7, 'num_maps': 4, 'shrinkage': 2},
+        'scan': {'patch_size_raw': 512, 'window_size_raw': window_size_raw,
+                 'padding_size_rel': padding_size_rel, 'extra_shrinkage': 4}
+    }
+    with open(os.path.join(netdir, 'config.json'), 'wt') as fp:
+        json.dump(config, fp)
+
+    # Random resnet, only needed because apply loads it
+    model_resnet = models.resnet18(pretrained=False)
+    model_resnet.fc = nn.Linear(model_resnet.fc.in_features, 2)
+    torch.save(model_resnet.state_dict(), os.path.join(netdir, 'resnet.dat'))
+
+    # Random wildcat model
+    cf = config['wildcat_upsample']
+    model_wildcat = resnet50_wildcat_upsample(2, pretrained=False, kmax=cf['kmax'],
+                                              alpha=cf['alpha'], num_maps=cf['num_maps'])
+    torch.save(model_wildcat.state_dict(), os.path.join(netdir, 'wildcat_upsample.dat'))
+
+
+# Run apply with one configuration and return the summary from the profile
+def run_apply(slide, netdir, output, profile, bsw, readers, k_super, extra_args):
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'wildcat_run.py'),
+           'apply', '--slide', slide, '--network', netdir, '--output', output,
+           '--bsw', str(bsw), '--readers', str(readers), '--super-window', str(k_super),
+           '--profile', profile] + extra_args
+
+    # Hide the GPUs so that the benchmark always runs on the CPU
+    env = dict(os.environ, CUDA_VISIBLE_DEVICES='')
+    print(' '.join(cmd))
+    subprocess.run(cmd, env=env, check=True, stdout=subprocess.DEVNULL)
+
+    with open(profile) as fp:
+        lines = [json.loads(line) for line in fp]
+    return lines[-1]['summary']
+
+
+# Compare two density maps, returning the maximum and mean absolute difference
+def compare_outputs(fn_ref, fn_test):
+    ref = sitk.GetArrayFromImage(sitk.ReadImage(fn_ref))
+    test = sitk.GetArrayFromImage(sitk.ReadImage(fn_test))
+    if ref.shape != test.shape:
+        return float('nan'), float('nan')
+    diff = np.abs(ref.astype(np.float64) - test)
+    return float(np.max(diff)), float(np.mean(diff))
+
+
+# Check if a difference returned by compare_outputs is within a (max, mean) tolerance.
+# Maps of different sizes are never within tolerance
+def within_tolerance(max_diff, mean_diff, tol):
+    return max_diff <= tol[0] and mean_diff <= tol[1]
+
+
+# Regression check of the pyramid level selection: apply with --read-level auto must
+# match the full resolution path (--read-level 0) within the tolerance. Raises an
+# exception otherwise
+def check_read_level(slide, netdir, workdir, tol):
+    outputs = {}
+    for level in ('0', 'auto'):
+        outputs[level] = os.path.join(workdir, 'density_read_level_%s.nii.gz' % (level,))
+        run_apply(slide, netdir, outputs[level], os.path.join(workdir, 'profile_read_level_%s.jsonl' % (level,)),
+                  8, 0, 1, ['--read-level', level])
+    max_diff, mean_diff = compare_outputs(outputs['0'], outputs['auto'])
+    print('Read level check: auto vs 0, max diff %.4g, mean diff %.4g (tolerance %g, %g)' %
+          (max_diff, mean_diff, tol[0], tol[1]))
+    if not within_tolerance(max_diff, mean_diff, tol):
+        raise Exception('Density map read from the auto level differs from level 0 by more than the tolerance')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark wildcat_run.py apply on a synthetic slide')
+    parser.add_argument('--workdir', help='Directory for the synthetic slide, networks and outputs',
+                        default='wildcat_bench')
+    parser.add_argument('--slide-size', help='Size of the synthetic slide in pixels', type=int, nargs=2,
+                        default=(32768, 24576))
+    parser.add_argument('--mpp', help='Pixel size of the synthetic slide, in microns', type=float, default=0.5)
+    parser.add_argument('--window-sizes', help='Values of window_size_raw', type=int, nargs='+', default=[4096])
+    parser.add_argument('--paddings', help='Values of padding_size_rel', type=float, nargs='+', default=[1.0])
+    parser.add_argument('--batch-sizes', help='Values of --bsw', type=int, nargs='+', default=[1, 8])
+    parser.add_argument('--readers', help='Values of --readers', type=int, nargs='+', default=[0, 4])
+    parser.add_argument('--super-windows', help='Values of --super-window, to compare halo sharing to '
+                        'per-window padding', type=int, nargs='+', default=[1])
+    parser.add_argument('--super-window-tolerance', help='Maximum and mean absolute difference in class '
+                        'probability allowed between super-window and per-window outputs', type=float, nargs=2,
+                        default=(0.05, 0.005), metavar=('MAX', 'MEAN'))
+    parser.add_argument('--check-read-level', help='Before the matrix, check that --read-level auto matches '
+                        '--read-level 0 within the tolerance, for the first window size and padding',
+                        action='store_true')
+    parser.add_argument('--read-level-tolerance', help='Maximum and mean absolute difference in class '
+                        'probability allowed between --read-level auto and 0', type=float, nargs=2,
+                        default=(0.1, 0.01), metavar=('MAX', 'MEAN'))
+    parser.add_argument('--apply-args', help='Extra arguments passed to apply, e.g., "--read-level 0"',
+                        default='')
+    parser.add_argument('--report', help='CSV file where to write the results')
+    args = parser.parse_args()
+
+    os.makedirs(args.workdir, exist_ok=True)
+
+    # Generate the slide once
+    slide = os.path.join(args.workdir, 'synthetic_%dx%d.tiff' % tuple(args.slide_size))
+    if not os.path.exists(slide):
+        print('Generating synthetic slide %s' % (slide,))
+        make_synthetic_slide(slide, args.slide_size[0], args.slide_size[1], args.mpp)
+
+    # Networks only differ in their scan parameters, and have the same weights
+    def get_network(ws, pad):
+        netdir = os.path.join(args.workdir, 'net_w%d_p%g' % (ws, pad))
+        if not os.path.exists(os.path.join(netdir, 'wildcat_upsample.dat')):
+            make_random_network(netdir, ws, pad)
+        return netdir
+
+    # Check the pyramid level selection against full resolution reads
+    if args.check_read_level:
+        check_read_level(slide, get_network(args.window_sizes[0], args.paddings[0]), args.workdir,
+                         args.read_level_tolerance)
+
+    # Run the matrix of configurations
+    results, refs = [], {}
+    for (ws, pad, k_super, bsw, readers) in itertools.product(args.window_sizes, args.paddings,
+                                                              args.super_windows, args.batch_sizes, args.readers):
+        netdir = get_network(ws, pad)
+
+        tag = 'w%d_p%g_k%d_b%d_r%d' % (ws, pad, k_super, bsw, readers)
+        output = os.path.join(args.workdir, 'density_%s.nii.gz' % (tag,))
+        profile = os.path.join(args.workdir, 'profile_%s.jsonl' % (tag,))
+        summary = run_apply(slide, netdir, output, profile, bsw, readers, k_super, args.apply_args.split())
+
+        # Compare to the first configuration with the same network. Super-windows are
+        # checked against the tolerance if that configuration uses per-window padding
+        (fn_ref, k_ref) = refs.setdefault((ws, pad), (output, k_super))
+        max_diff, mean_diff = compare_outputs(fn_ref, output)
+        flag = k_super > 1 and k_ref == 1 and not within_tolerance(max_diff, mean_diff,
+                                                                   args.super_window_tolerance)
+
+        results.append({
+            'window_size_raw': ws, 'padding_size_rel': pad, 'super_window': k_super,
+            'bsw': bsw, 'readers': readers, 'windows': summary['windows'], 'wall_time': summary['wall_time'],
+            'windows_per_sec': summary['cells_per_sec'], 'read_mb_per_sec': summary['read_mb_per_sec'],
+            'peak_rss_mb': max(summary['peak_rss_mb'], summary['peak_rss_children_mb']),
+            'max_diff': max_diff, 'mean_diff': mean_diff, 'exceeds_tolerance': flag })
+
+    # Report
+    print('%8s %6s %5s %5s %7s %8s %10s %10s %10s %10s %10s' %
+          ('window', 'pad', 'super', 'bsw', 'readers', 'windows', 'win/sec', 'MB/sec', 'RSS (MB)',
+           'max diff', 'mean diff'))
+    for r in results:
+        print('%8d %6g %5d %5d %7d %8d %10.3f %10.1f %10.1f %10.3g %10.3g %s' %
+              (r['window_size_raw'], r['padding_size_rel'], r['super_window'], r['bsw'], r['readers'], r['windows'],
+               r['windows_per_sec'], r['read_mb_per_sec'], r['peak_rss_mb'], r['max_diff'], r['mean_diff'],
+               'EXCEEDS TOLERANCE' if r['exceeds_tolerance'] else ''))
+
+    if args.report is not None:
+        with open(args.report, 'wt') as fp:
+            writer = csv.DictWriter(fp, fieldnames=list(results[0].keys()))
+            writer.writeheader()
+            writer.writerows(results)
+
+    # Fail if halo sharing changed the outputs by more than the tolerance
+    if any(r['exceeds_tolerance'] for r in results):
+        print('Super-window outputs differ from per-window padding by more than %g (max) or %g (mean)' %
+              tuple(args.super_window_tolerance))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -10,6 +10,13 @@ from torchvision import datasets, models, transforms
 import matplotlib.pyplot as plt
 import time
 import os
+import shutil
+import tempfile
+import gzip
+import struct
+import hashlib
+import resource
+import platform
 import copy
 import torch.cuda as cutorch
 import timeit
@@ -21,41 +28,453 @@ import json
 import SimpleITK as sitk
 import threading
 import queue
+import collections
+import itertools
+import csv
 import parse
 import traceback
+import PIL.Image
 
 # Import wildcat models
 sys.path.append("wildcat.pytorch")
 import wildcat.models
 
+# Shared modules in the parent directory (burden_stats.py)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
 # Import wildcat mods
 from unet_wildcat import *
 
 # Set up the device (CPU/GPU)
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
-# Set up a queue for image chunks
-chunk_q = queue.Queue(4)
+# Read a padded window from the slide and preprocess it into float32 tensors ready
+# to be passed to WildCat. The window is read once from the given pyramid level and,
+# for each network, the excess padding (in level pixels) is cropped before the
+# network's transforms are applied. Also returns the time spent in each stage
+def read_window(osl, window, window_size_raw, padding_size_raw, level, crops):
+
+    # Get the coordinates of the window in raw pixels
+    (u,v) = window
+    x,y = u*window_size_raw,v*window_size_raw
+
+    # Subtract the padding
+    xp,yp,wp = x-padding_size_raw,y-padding_size_raw,window_size_raw+2*padding_size_raw
+
+    # Size of the window at the pyramid level
+    wl = int(round(wp / osl.level_downsamples[level]))
+
+    # Read the chunk from the image. OpenSlide decodes the tiles as part of the read, so
+    # the read time includes decoding. Conversion from RGBA to RGB is timed separately
+    t0 = timeit.default_timer()
+    chunk_rgba=osl.read_region((xp,yp), level, (wl,wl))
+    t1 = timeit.default_timer()
+    chunk_img=chunk_rgba.convert("RGB")
+    t2 = timeit.default_timer()
+
+    # Apply the transforms
+    chunks = [tran(chunk_img.crop((c, c, wl-c, wl-c)) if c > 0 else chunk_img) for (c, tran) in crops]
+    t3 = timeit.default_timer()
+    return chunks, {'read': t1-t0, 'convert': t2-t1, 'preprocess': t3-t2, 'read_bytes': wl*wl*4}
+
+
+# Choose the coarsest pyramid level whose pixels are no larger than the given
+# number of raw pixels, so that only a residual resize is needed after reading
+def choose_read_level(osl, max_downsample):
+    level = 0
+    for lev in range(osl.level_count):
+        if osl.level_downsamples[lev] <= max_downsample * 1.001:
+            level = lev
+    return level
+
 
 # Define the worker function to load chunks from the openslide image
-def osl_worker(osl, u_range, v_range, window_size_raw, padding_size_raw):
-    for u in range(u_range[0], u_range[1]):
-        for v in range(v_range[0], v_range[1]):
+def osl_worker(osl, chunk_q, windows, window_size_raw, padding_size_raw, level, crops):
+    try:
+        for window in windows:
+            chunk_q.put((window,) + read_window(osl, window, window_size_raw, padding_size_raw, level, crops))
+    except:
+        traceback.print_exc()
+    finally:
+        # Put a sentinel value, even if reading failed, so the main loop does not hang
+        chunk_q.put(None)
 
-            # Get the coordinates of the window in raw pixels
-            x,y,w = u*window_size_raw,v*window_size_raw,window_size_raw
 
-            # Subtract the padding
-            xp,yp,wp = x-padding_size_raw,y-padding_size_raw,window_size_raw+2*padding_size_raw
+# Generate preprocessed windows in order using a single reader thread
+def iter_windows_thread(osl, windows, window_size_raw, padding_size_raw, level, crops, prefetch=4):
 
-            # Read the chunk from the image
-            chunk_img=osl.read_region((xp,yp), 0, (wp,wp)).convert("RGB")
+    # Set up a queue for image chunks
+    chunk_q = queue.Queue(prefetch)
 
-            # Place into queue
-            chunk_q.put(((x,y,w), (xp,yp,wp), chunk_img))
+    # Set up a threaded worker to read openslide patches
+    worker = threading.Thread(target=osl_worker,
+                              args=(osl, chunk_q, windows, window_size_raw, padding_size_raw, level, crops))
+    worker.daemon = True
+    worker.start()
+
+    try:
+        while True:
+            q_data = chunk_q.get()
+
+            # Check for sentinel value
+            if q_data is None:
+                break
+
+            yield q_data
+
+    finally:
+        # Drain the queue in case the consumer stopped early so the worker can finish
+        while worker.is_alive():
+            try:
+                chunk_q.get(timeout=1)
+            except queue.Empty:
+                pass
+        worker.join()
+
+
+# State of a reader process. Each process opens its own OpenSlide handle
+# because handles cannot be shared across processes
+osl_reader = None
+
+
+def osl_reader_init(slide, window_size_raw, padding_size_raw, level, crops):
+    global osl_reader
+    torch.set_num_threads(1)
+    osl_reader = (openslide.OpenSlide(slide), window_size_raw, padding_size_raw, level, crops)
+
+
+def osl_reader_read(window):
+    (osl, window_size_raw, padding_size_raw, level, crops) = osl_reader
+
+    # Tensors returned through torch.multiprocessing are moved to shared memory,
+    # so the main process receives them without another copy of the pixel data
+    return (window,) + read_window(osl, window, window_size_raw, padding_size_raw, level, crops)
+
+
+# Generate preprocessed windows in order using a pool of reader processes. At most
+# prefetch windows are in flight at any time, which bounds memory use
+def iter_windows_pool(slide, windows, window_size_raw, padding_size_raw, level, crops, n_readers, prefetch):
+    ctx = torch.multiprocessing.get_context('spawn')
+    with ctx.Pool(n_readers, initializer=osl_reader_init,
+                  initargs=(slide, window_size_raw, padding_size_raw, level, crops)) as pool:
+        pending = collections.deque()
+        w_iter = iter(windows)
+        for window in itertools.islice(w_iter, prefetch):
+            pending.append(pool.apply_async(osl_reader_read, (window,)))
+
+        while len(pending) > 0:
+            result = pending.popleft().get()
+            window = next(w_iter, None)
+            if window is not None:
+                pending.append(pool.apply_async(osl_reader_read, (window,)))
+            yield result
+
+
+# Compute a low-resolution tissue mask, either from a coarse level of the slide
+# pyramid ('slide') or from the *_rgb_40um.nii.gz image generated during slide
+# preprocessing. Tissue is detected as pixels with color saturation above the
+# threshold. Returns the mask, the size of a mask pixel in raw slide pixels and
+# the median color of the glass, or None if no mask could be computed
+def compute_tissue_mask(osl, source, sat_threshold, max_dim=4096):
+    if source == 'slide':
+        # Use the finest pyramid level that is small enough
+        lev = next((l for l in range(osl.level_count) if max(osl.level_dimensions[l]) <= max_dim), None)
+        if lev is None:
+            print('No pyramid level smaller than %d pixels, tissue mask not computed' % (max_dim,))
+            return None
+        rgba = np.asarray(osl.read_region((0,0), lev, osl.level_dimensions[lev]))
+        rgb, valid = rgba[:,:,0:3].astype(np.int16), rgba[:,:,3] > 0
+    else:
+        rgb = sitk.GetArrayFromImage(sitk.ReadImage(source)).astype(np.int16)
+        valid = np.ones(rgb.shape[0:2], dtype=bool)
+
+    # Threshold the saturation
+    sat = np.amax(rgb, axis=2) - np.amin(rgb, axis=2)
+    mask = np.logical_and(valid, sat >= sat_threshold)
 
-    # Put a sentinel value
-    chunk_q.put(None)
+    # The color of the glass, used to compute the background value of the network
+    glass = rgb[np.logical_and(valid, np.logical_not(mask))]
+    bg_color = tuple(int(c) for c in np.median(glass, axis=0)) if len(glass) else (255,255,255)
+
+    # Size of the mask pixel in raw pixels
+    mask_pix = np.array(osl.dimensions) / np.array((mask.shape[1], mask.shape[0]))
+    return mask, mask_pix, bg_color
+
+
+# Check if the padded window contains any tissue in the mask
+def window_has_tissue(mask, mask_pix, window, window_size_raw, padding_size_raw):
+    (u,v) = window
+    x0,y0 = u*window_size_raw-padding_size_raw,v*window_size_raw-padding_size_raw
+    x1,y1 = x0+window_size_raw+2*padding_size_raw,y0+window_size_raw+2*padding_size_raw
+    j0,j1 = max(0, int(np.floor(x0/mask_pix[0]))),int(np.ceil(x1/mask_pix[0]))
+    i0,i1 = max(0, int(np.floor(y0/mask_pix[1]))),int(np.ceil(y1/mask_pix[1]))
+    return np.any(mask[i0:i1,j0:j1])
+
+
+# The part of the WildCat model needed to compute density maps: the forward pass
+# up to the classifier followed by class-wise pooling. This is what gets exported
+class WildcatClassWise(nn.Module):
+    def __init__(self, model_wildcat):
+        super(WildcatClassWise, self).__init__()
+        self.model_wildcat = model_wildcat
+
+    def forward(self, x):
+        x_clas = self.model_wildcat.forward_to_classifier(x)
+        return self.model_wildcat.spatial_pooling.class_wise(x_clas)
+
+
+# Transforms that convert a window read from the slide into a normalized tensor
+# of the size expected by the network
+def make_transform(wwc):
+    return transforms.Compose([
+        transforms.Resize((wwc,wwc)),
+        transforms.ToTensor(),
+        transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+    ])
+
+
+# Run WildCat on a batch of preprocessed windows. The forward function maps a CPU
+# tensor of windows to the class-wise pooled output. If a timings dictionary is
+# given, the time of the forward pass is added to it
+def forward_wildcat(forward, chunk_tensor, timings=None):
+    with torch.no_grad():
+        t0 = timeit.default_timer()
+        x_cpool = forward(chunk_tensor)
+        if x_cpool.is_cuda:
+            torch.cuda.synchronize()
+        t1 = timeit.default_timer()
+
+    if timings is not None:
+        timings['forward'] = timings.get('forward', 0.0) + t1 - t0
+    return x_cpool
+
+
+# Scale the class-wise output of WildCat to the output resolution
+def upsample_wildcat(x_cpool, extra_shrinkage, timings=None):
+    with torch.no_grad():
+        t1 = timeit.default_timer()
+        x_cpool_up = torch.nn.functional.interpolate(x_cpool, scale_factor=1.0/extra_shrinkage).detach().cpu().numpy()
+        t2 = timeit.default_timer()
+
+    if timings is not None:
+        timings['interpolate'] = timings.get('interpolate', 0.0) + t2 - t1
+    return x_cpool_up
+
+
+# Run WildCat on a batch of preprocessed windows and scale the class-wise
+# output to the output resolution
+def apply_wildcat(forward, chunk_tensor, extra_shrinkage, timings=None):
+    return upsample_wildcat(forward_wildcat(forward, chunk_tensor, timings), extra_shrinkage, timings)
+
+
+# Identify a file by its path, size and modification time
+def file_ident(path):
+    st = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': st.st_size, 'mtime': st.st_mtime}
+
+
+# Hash of the contents of a file
+def file_sha1(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+# Identify a slide by its contents rather than its path. OpenSlide provides a hash of
+# the metadata and lowest resolution level; for other files the header is hashed
+def slide_fingerprint(osl, path):
+    qh = osl.properties.get('openslide.quickhash-1')
+    if qh is None:
+        with open(path, 'rb') as fp:
+            qh = hashlib.sha1(fp.read(1 << 20)).hexdigest()
+    return '%s:%d' % (qh, os.path.getsize(path))
+
+
+# Open a content-addressed cache of the raw class-wise output of the networks for
+# single windows, stored as one .npy file per window. The total size of the cache
+# is capped, and the least recently used windows are evicted first. The modification
+# time of a file records when it was last used, so the order survives across runs
+def open_window_cache(cache_dir, max_size_gb):
+    os.makedirs(cache_dir, exist_ok=True)
+    entries = []
+    for fn in os.listdir(cache_dir):
+        if fn.endswith('.npy'):
+            st = os.stat(os.path.join(cache_dir, fn))
+            entries.append((st.st_mtime, fn[:-4], st.st_size))
+    lru = collections.OrderedDict((key, size) for (_, key, size) in sorted(entries))
+    return {'dir': cache_dir, 'max_bytes': int(max_size_gb * 2**30), 'lru': lru,
+            'size': sum(lru.values()), 'hits': 0, 'misses': 0}
+
+
+# Key of a window in the cache, from the parameters that determine the raw output
+def window_cache_key(params, window):
+    return hashlib.sha1(json.dumps([params, [int(x) for x in window]], sort_keys=True).encode()).hexdigest()
+
+
+# Look up a window in the cache, returning None if it is not there
+def window_cache_get(cache, key):
+    fn = os.path.join(cache['dir'], key + '.npy')
+    if key in cache['lru']:
+        try:
+            x_cpool = np.load(fn)
+            os.utime(fn)
+            cache['lru'].move_to_end(key)
+            cache['hits'] += 1
+            return x_cpool
+        except (IOError, ValueError):
+            # The entry was removed or truncated by another process
+            cache['size'] -= cache['lru'].pop(key)
+    cache['misses'] += 1
+    return None
+
+
+# Store a window in the cache, evicting the least recently used windows to stay
+# within the size cap. Files are renamed into place so that readers never see
+# partial entries
+def window_cache_put(cache, key, x_cpool):
+    fn = os.path.join(cache['dir'], key + '.npy')
+    fn_tmp = '%s.%d.tmp' % (fn, os.getpid())
+    with open(fn_tmp, 'wb') as fp:
+        np.save(fp, x_cpool)
+    os.replace(fn_tmp, fn)
+    size = os.path.getsize(fn)
+    cache['size'] += size - cache['lru'].pop(key, 0)
+    cache['lru'][key] = size
+    while cache['size'] > cache['max_bytes'] and len(cache['lru']) > 1:
+        (key_old, size_old) = cache['lru'].popitem(last=False)
+        cache['size'] -= size_old
+        try:
+            os.remove(os.path.join(cache['dir'], key_old + '.npy'))
+        except OSError:
+            pass
+
+
+
+# Get the raw outputs of all the networks for all the windows of a batch from the cache,
+# as a list of (window, network index, x_cpool), or None if any of them is missing
+def window_cache_get_batch(cache, nets, batch_windows):
+    hits = []
+    for (u,v) in batch_windows:
+        for (k, net) in enumerate(nets):
+            x_cpool = window_cache_get(cache, window_cache_key(net['cache_params'], (u,v)))
+            if x_cpool is None:
+                return None
+            hits.append(((u,v), k, x_cpool))
+    return hits
+
+# Open the on-disk partial result of a checkpointed run, or create a new one if
+# there is no checkpoint or it was made for a different slide, network or output.
+# Returns the memory-mapped density arrays (one per network) and the window
+# completion bitmap
+def open_checkpoint(ckpt_dir, ident, density_shapes, density_dtype, n_win):
+    fn_json = os.path.join(ckpt_dir, 'checkpoint.json')
+    fn_density = [os.path.join(ckpt_dir, 'density_%d.npy' % k) for k in range(len(density_shapes))]
+    fn_done = os.path.join(ckpt_dir, 'done.npy')
+
+    # Check if the existing checkpoint matches this run
+    if os.path.exists(fn_json):
+        with open(fn_json) as fp:
+            ident_old = json.load(fp)
+        if ident_old == ident and all(os.path.exists(fn) for fn in fn_density + [fn_done]):
+            done = np.lib.format.open_memmap(fn_done, mode='r+')
+            print('Resuming from checkpoint %s, %d windows already completed' % (ckpt_dir, np.sum(done)))
+            return [np.lib.format.open_memmap(fn, mode='r+') for fn in fn_density], done
+        print('Checkpoint %s does not match this run, starting over' % (ckpt_dir,))
+        os.remove(fn_json)
+
+    # Create new arrays. The identity is written last, so that an interrupted
+    # initialization is never mistaken for a valid checkpoint
+    os.makedirs(ckpt_dir, exist_ok=True)
+    densities = [np.lib.format.open_memmap(fn, mode='w+', dtype=density_dtype, shape=shape)
+                 for (fn, shape) in zip(fn_density, density_shapes)]
+    done = np.lib.format.open_memmap(fn_done, mode='w+', dtype=np.uint8, shape=tuple(n_win))
+    for density in densities:
+        density.flush()
+    done.flush()
+    with open(fn_json, 'wt') as fp:
+        json.dump(ident, fp)
+    return densities, done
+
+
+# Remove the files of a checkpoint once the run is complete. The directory itself is
+# only removed if nothing else is left in it, since it may hold unrelated files
+def remove_checkpoint(ckpt_dir, n_density):
+    fn_all = [os.path.join(ckpt_dir, 'density_%d.npy' % k) for k in range(n_density)]
+    fn_all += [os.path.join(ckpt_dir, 'done.npy'), os.path.join(ckpt_dir, 'checkpoint.json')]
+    for fn in fn_all:
+        if os.path.exists(fn):
+            os.remove(fn)
+    try:
+        os.rmdir(ckpt_dir)
+    except OSError:
+        pass
+
+
+# Write a multi-component 2D image stored as a CxYxX array to a NIfTI file (optionally
+# gzipped), in strips of rows. This avoids holding a transposed copy of the whole
+# image in memory. The header matches what SimpleITK writes for vector images
+def write_nifti_strips(filename, data, spacing, strip_rows=256):
+    (nc, ny, nx) = data.shape
+    (sx, sy) = spacing
+    hdr = struct.pack('<i10s18sihbb8h3f4h8f3fhbb4f2i80s24s2h6f4f4f4f16s4s',
+                      348, b'', b'', 0, 0, b'r'[0], 0,
+                      5, nx, ny, 1, 1, nc, 1, 1,            # dim: x, y, z, t, components
+                      0.0, 0.0, 0.0, 1007, 16, 32, 0,       # intent vector, datatype float32
+                      1.0, sx, sy, 1.0, 1.0, 1.0, 1.0, 1.0, # pixdim
+                      352.0, 1.0, 0.0, 0, 0, 2,             # vox_offset, scaling, units mm
+                      0.0, 0.0, 0.0, 0.0, 0, 0,
+                      b'wildcat density map', b'',
+                      1, 1,                                 # qform and sform codes
+                      0.0, 0.0, 1.0, 0.0, 0.0, 0.0,         # LPS to RAS quaternion
+                      -sx, 0.0, 0.0, 0.0,
+                      0.0, -sy, 0.0, 0.0,
+                      0.0, 0.0, 1.0, 0.0,
+                      b'', b'n+1\0')
+
+    # NIfTI stores x fastest and components slowest, which is the order of data
+    opener = gzip.open if filename.endswith('.gz') else open
+    with opener(filename, 'wb') as fp:
+        fp.write(hdr)
+        fp.write(b'\0' * 4)
+        for c in range(nc):
+            for y0 in range(0, ny, strip_rows):
+                fp.write(np.ascontiguousarray(data[c,y0:y0+strip_rows,:], dtype='<f4').tobytes())
+
+
+# Report the peak resident memory of this process and its finished children, in MB
+def report_peak_rss():
+    rss_self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    rss_child = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024.0
+    print("Peak RSS: %8.1f MB (main process), %8.1f MB (largest child process)" % (rss_self, rss_child))
+    return rss_self, rss_child
+
+
+# Stages of processing a window that are timed by the profiler. The read stage includes
+# decoding the slide tiles, and the convert stage is the conversion from RGBA to RGB
+profile_stages = ('queue_wait', 'read', 'convert', 'preprocess', 'forward', 'interpolate', 'copy')
+
+
+# Summarize the per-window timings of a run: percentiles of each stage, throughput
+# and peak memory
+def profile_summary(records, wall_time, peak_rss):
+    summary = {
+        'windows': len(records),
+        'wall_time': wall_time,
+        'windows_per_sec': len(records) / wall_time if wall_time > 0 else 0.0,
+        'cells_per_sec': sum(rec.get('cells', 1) for rec in records) / wall_time if wall_time > 0 else 0.0,
+        'peak_rss_mb': peak_rss[0],
+        'peak_rss_children_mb': peak_rss[1],
+        'read_mb_per_sec': sum(rec['read_bytes'] for rec in records) / 2.0**20 / wall_time if wall_time > 0 else 0.0 }
+    if device.type == 'cuda':
+        summary['peak_cuda_mb'] = torch.cuda.max_memory_allocated() / 2.0**20
+    for stage in profile_stages:
+        t = np.array([rec[stage] for rec in records]) if len(records) else np.zeros(1)
+        summary[stage] = { 'total': float(np.sum(t)), 'mean': float(np.mean(t)),
+                           'p50': float(np.percentile(t, 50)), 'p90': float(np.percentile(t, 90)),
+                           'p99': float(np.percentile(t, 99)), 'max': float(np.max(t)) }
+    return summary
 
 
 def do_info(args):
@@ -69,59 +488,78 @@ def read_openslide_chunk(osl, pos, level, size):
     chunk_img=osl.read_region(pos, level, size).convert("RGB")
 
 
-# Function to apply training to a slide
-def do_apply(args):
+# Load a trained WildCat network and derive the geometry used to scan slides with it.
+# With the eager backend, the network directory is the one saved during training.
+# Other backends use a directory created by the export command
+def load_network(network, backend='eager'):
 
     # Read the .json config file
-    with open(os.path.join(args.network, 'config.json')) as json_file:
+    with open(os.path.join(network, 'config.json')) as json_file:
         config=json.load(json_file)
 
-    # Read the resnet portion of the config
-    cf_resnet = config['resnet']
+    # Read the wildcat portion of the config
+    cf_wildcat = config['wildcat_upsample']
 
-    # Create the resnet model
-    if cf_resnet['size'] == 50:
-        model_resnet = models.resnet50(pretrained=False)
-    elif cf_resnet['size'] == 18:
-        model_resnet = models.resnet18(pretrained=False)
-    else:
-        raise 'Incompatible resnet model size'
+    if backend == 'eager':
 
-    # Load the resnet model
-    model_resnet.fc = nn.Linear(model_resnet.fc.in_features, cf_resnet['num_classes'])
-    model_resnet.load_state_dict(torch.load(
-        os.path.join(args.network, 'resnet.dat'),
-        map_location=device))
-    model_resnet.eval()
-    model_resnet = model_resnet.to(device)
+        # Read the resnet portion of the config
+        cf_resnet = config['resnet']
 
-    # Read the wildcat portion of the config
-    cf_wildcat = config['wildcat_upsample']
+        # Create the resnet model
+        if cf_resnet['size'] == 50:
+            model_resnet = models.resnet50(pretrained=False)
+        elif cf_resnet['size'] == 18:
+            model_resnet = models.resnet18(pretrained=False)
+        else:
+            raise 'Incompatible resnet model size'
 
-    # Read the wildcat model
-    model_wildcat = resnet50_wildcat_upsample(
-            2, pretrained=False,
-            kmax=cf_wildcat['kmax'],
-            alpha=cf_wildcat['alpha'],
-            num_maps=cf_wildcat['num_maps'])
+        # Load the resnet model
+        model_resnet.fc = nn.Linear(model_resnet.fc.in_features, cf_resnet['num_classes'])
+        model_resnet.load_state_dict(torch.load(
+            os.path.join(network, 'resnet.dat'),
+            map_location=device))
+        model_resnet.eval()
+        model_resnet = model_resnet.to(device)
 
-    model_wildcat.load_state_dict(
-            torch.load(
-                os.path.join(args.network, 'wildcat_upsample.dat'),
-                map_location=device))
+        # Read the wildcat model
+        model_wildcat = resnet50_wildcat_upsample(
+                2, pretrained=False,
+                kmax=cf_wildcat['kmax'],
+                alpha=cf_wildcat['alpha'],
+                num_maps=cf_wildcat['num_maps'])
 
-    # Read the parameters for scanning
-    cf_scan = config['scan']
+        weights = os.path.join(network, 'wildcat_upsample.dat')
+        model_wildcat.load_state_dict(torch.load(weights, map_location=device))
 
-    # Set evaluation mode
-    model_wildcat.eval()
+        # Set evaluation mode
+        model_wildcat.eval()
 
-    # Send model to GPU
-    model_wildcat = model_wildcat.to(device)
+        # Send model to GPU
+        module = WildcatClassWise(model_wildcat).to(device)
+        forward = lambda x: module(x.to(device))
 
-    # Read the input using OpenSlide
-    osl=openslide.OpenSlide(args.slide)
-    slide_dim = np.array(osl.dimensions)
+    else:
+
+        # Read the description of the exported model
+        with open(os.path.join(network, 'export.json')) as json_file:
+            cf_export=json.load(json_file)
+        if cf_export['format'] != backend:
+            raise Exception('Network %s was exported as %s, not %s' % (network, cf_export['format'], backend))
+        weights = os.path.join(network, cf_export['file'])
+        module = None
+
+        if backend == 'torchscript':
+            ts_module = torch.jit.load(weights, map_location=device)
+            forward = lambda x: ts_module(x.to(device))
+        elif backend == 'onnx':
+            import onnxruntime
+            session = onnxruntime.InferenceSession(weights, providers=['CPUExecutionProvider'])
+            forward = lambda x: torch.from_numpy(session.run(None, {'input': x.numpy()})[0])
+        else:
+            raise Exception('Unknown backend %s' % (backend,))
+
+    # Read the parameters for scanning
+    cf_scan = config['scan']
 
     # Size of the training patch used to train wildcat, in raw pixels
     patch_size_raw = cf_scan.get('patch_size_raw', 512)
@@ -145,20 +583,164 @@ def do_apply(args):
     # Size of output pixel (in input pixels)
     out_pix_size = wildcat_shrinkage * extra_shrinkage * patch_size_raw * 1.0 / input_size_wildcat
 
-    # The output size for each window
-    window_size_out = int(window_size_raw / out_pix_size)
+    return {
+        'network': network,
+        'config': config,
+        'weights': weights,
+        'module': module,
+        'forward': forward,
+        'patch_size_raw': patch_size_raw,
+        'window_size_raw': window_size_raw,
+        'padding_size_raw': padding_size_raw,
+        'extra_shrinkage': extra_shrinkage,
+        'out_pix_size': out_pix_size,
+
+        # The output size for each window
+        'window_size_out': int(window_size_raw / out_pix_size),
+
+        # The padding size for the output
+        'padding_size_out': int(padding_size_rel * patch_size_raw / out_pix_size)
+    }
+
+
+# Read the samples drawn on a slide from a HistoAnnot sample manifest, generated with
+# flask samples-export-csv <task> manifest.csv --ids --specimen --header
+def read_samples(manifest, slide_name, stain=None):
+    with open(manifest, newline='') as fp:
+        return [row for row in csv.DictReader(fp)
+                if row['slide_name'] == slide_name and (stain is None or row['stain'] == stain)]
+
+
+# Compute the burden statistics of samples from a density map stored as CxYxX, with
+# the same code as integrate_density_over_samples.py (burden_stats.py in the parent
+# directory): the mean of the burden (difference between the two classes, clipped at
+# zero) in the sample box, and the maximum of the burden averaged by a sliding window of
+# mean_filter_size raw pixels within the box
+def sample_burden(density, slide_dim, samples, mean_filter_size):
+    from burden_stats import integral_image, roi_burden
+    sx = density.shape[2] * 1.0 / slide_dim[0]
+    sy = density.shape[1] * 1.0 / slide_dim[1]
+    fx, fy = int(sx * mean_filter_size + 0.5), int(sy * mean_filter_size + 0.5)
+    result = []
+    for row in samples:
+        nx, ny = int(sx * float(row['x']) + 0.5), int(sy * float(row['y']) + 0.5)
+        nw, nh = int(sx * float(row['w']) + 0.5), int(sy * float(row['h']) + 0.5)
+        roi = np.maximum(np.asarray(density[1,ny:ny+nh,nx:nx+nw], dtype=np.float64) -
+                         np.asarray(density[0,ny:ny+nh,nx:nx+nw], dtype=np.float64), 0.0)
+
+        # The burden statistics take maps indexed by x first
+        result.append(roi_burden(integral_image(roi.T), 0, 0, nw, nh, fx, fy))
+    return result
+
+
+# Get the size of the raw slide pixel, in mm units
+def get_slide_spacing(osl):
+    (sx, sy) = (0.0, 0.0)
+    if 'openslide.mpp-x' in osl.properties:
+        sx = float(osl.properties['openslide.mpp-x']) / 1000.0
+        sy = float(osl.properties['openslide.mpp-y']) / 1000.0
+    elif 'openslide.comment' in osl.properties:
+        for z in osl.properties['openslide.comment'].split('\n'):
+            r = parse.parse('Resolution = {} um', z)
+            if r is not None:
+                sx = float(r[0]) / 1000.0
+                sy = float(r[0]) / 1000.0
+
+    # Fall back on the TIFF resolution tags, e.g., for generic tiled TIFF files
+    if (sx == 0.0 or sy == 0.0) and all(['tiff.' + x in osl.properties
+                                         for x in ('XResolution','YResolution','ResolutionUnit')]):
+        rbase = {'centimeter':10.0, 'millimeter':1.0}.get(osl.properties['tiff.ResolutionUnit'], 0.0)
+        sx = rbase / float(osl.properties['tiff.XResolution'])
+        sy = rbase / float(osl.properties['tiff.YResolution'])
+
+    # If there is no spacing, throw exception
+    if sx == 0.0 or sy == 0.0:
+      raise Exception('No spacing information in image')
+
+    return (sx, sy)
+
 
-    # The padding size for the output
-    padding_size_out = int(padding_size_rel * patch_size_raw / out_pix_size)
+# Function to apply training to a slide. Several networks can be applied in a
+# single pass over the slide, each producing its own density map
+def do_apply(args):
+
+    # Each network needs its own output, which may be omitted if only burden statistics are wanted
+    if args.output is None and args.burden is None:
+        raise Exception('At least one of --output and --burden is required')
+    if args.burden is not None and args.samples is None:
+        raise Exception('Burden statistics require a sample manifest (--samples)')
+    if args.output is not None and len(args.network) != len(args.output):
+        raise Exception('The number of outputs (%d) must match the number of networks (%d)' %
+                        (len(args.output), len(args.network)))
+
+    # Load the networks
+    nets = [load_network(network, args.backend) for network in args.network]
+
+    # The networks share the window grid. Windows are read once with the largest
+    # padding and each network crops the padding it needs
+    window_size_raw = nets[0]['window_size_raw']
+    if any(net['window_size_raw'] != window_size_raw for net in nets):
+        raise Exception('All networks must use the same window_size_raw')
+    padding_size_raw = max(net['padding_size_raw'] for net in nets)
+
+    # Read the input using OpenSlide
+    osl=openslide.OpenSlide(args.slide)
+    slide_dim = np.array(osl.dimensions)
+    n_base_win = np.ceil(slide_dim / window_size_raw).astype(int)
+
+    # Halo sharing: blocks of k x k windows are merged into super-windows that are read and
+    # passed through the network as a single window, so neighbouring windows share their
+    # padding instead of each reading and convolving its own. Each window in the block sees
+    # at least the context it has in the per-window scheme, so the two differ only where the
+    # receptive field of the network extends past the padding. The difference has not been
+    # measured for a trained network. wildcat_bench.py --super-windows 1 k measures it and
+    # flags configurations that exceed its limit (by default 0.05 max and 0.005 mean
+    # absolute difference in class probability)
+    k_super = max(1, int(args.super_window))
+    if k_super > 1:
+        if args.backend == 'onnx':
+            raise Exception('Super-windows require the eager or torchscript backend')
+        for net in nets:
+            net['window_size_raw'] *= k_super
+            net['window_size_out'] *= k_super
+        window_size_raw *= k_super
+        print('Processing %dx%d windows per pass' % (k_super, k_super))
+    wp = window_size_raw + 2 * padding_size_raw
 
     # Total number of non-overlapping windows to process
     n_win = np.ceil(slide_dim / window_size_raw).astype(int)
 
-    # Output image size
-    out_dim=(n_win * window_size_out).astype(int)
-
-    # Output array (last dimension is per-class probabilities)
-    density=np.zeros((2, out_dim[0], out_dim[1]))
+    # Output image size for each network
+    for net in nets:
+        net['out_dim'] = (n_win * net['window_size_out']).astype(int)
+
+    # Output arrays of per-class probabilities, stored as CxYxX. The arrays are memory-mapped
+    # so that large slides do not need to fit in memory. For checkpointed runs they persist
+    # across restarts, along with a bitmap of completed windows
+    density_shapes = [(2, net['out_dim'][1], net['out_dim'][0]) for net in nets]
+    density_dtype = np.dtype(args.dtype)
+    if args.checkpoint is not None:
+
+        # Deterministic kernels, so that resumed windows match an uninterrupted run
+        torch.backends.cudnn.deterministic = True
+        torch.backends.cudnn.benchmark = False
+
+        ident = {
+            'slide': file_ident(args.slide),
+            'network': [file_ident(net['weights']) for net in nets],
+            'config': [net['config'] for net in nets],
+            'output': [os.path.abspath(output) for output in args.output or []],
+            'bsw': args.bsw, 'super_window': k_super, 'region': args.region, 'dtype': args.dtype, 'read_level': args.read_level,
+            'tissue_mask': args.tissue_mask, 'tissue_threshold': args.tissue_threshold }
+        densities, win_done = open_checkpoint(args.checkpoint, ident, density_shapes, density_dtype, n_win)
+        scratch = None
+    else:
+        # The scratch directory is also removed when the run fails and the process exits
+        scratch = tempfile.TemporaryDirectory(prefix='wildcat_')
+        densities = [np.lib.format.open_memmap(os.path.join(scratch.name, 'density_%d.npy' % k), mode='w+',
+                                               dtype=density_dtype, shape=shape)
+                     for (k, shape) in enumerate(density_shapes)]
+        win_done = None
 
     # Range of pixels to scan
     u_range,v_range = (0,n_win[0]),(0,n_win[1])
@@ -170,82 +752,225 @@ def do_apply(args):
             u_range=(int(R[0]*n_win[0]),int((R[0]+R[2])*n_win[0]))
             v_range=(int(R[1]*n_win[1]),int((R[1]+R[3])*n_win[1]))
         else:
-            u_range=(int(R[0]), int(R[0]+R[2]))
-            v_range=(int(R[1]), int(R[1]+R[3]))
+            u_range=(int(R[0]) // k_super, (int(R[0]+R[2]) + k_super - 1) // k_super)
+            v_range=(int(R[1]) // k_super, (int(R[1]+R[3]) + k_super - 1) // k_super)
 
     print('Procesing region [%d %d] to [%d %d]' % (u_range[0], v_range[0], u_range[1], v_range[1]))
 
-    # Set up a threaded worker to read openslide patches
-    worker = threading.Thread(target=osl_worker, args=(osl, u_range, v_range, chunk_width, overhang))
-    worker.start()
-
-    # Try/catch block to kill worker when done
+    # List of windows to process, in scan order
+    windows = [(u,v) for u in range(u_range[0], u_range[1]) for v in range(v_range[0], v_range[1])]
+
+    # Restrict the scan to the windows that cover the samples drawn on this slide in a
+    # HistoAnnot manifest, with a margin of one output pixel for rounding
+    samples = None
+    if args.samples is not None:
+        slide_name = args.slide_name or os.path.splitext(os.path.basename(args.slide))[0]
+        samples = read_samples(args.samples, slide_name, args.stain)
+        margin = max(net['out_pix_size'] for net in nets)
+        cover = set()
+        for row in samples:
+            x0, y0 = float(row['x']) - margin, float(row['y']) - margin
+            x1, y1 = x0 + float(row['w']) + 2 * margin, y0 + float(row['h']) + 2 * margin
+            cover.update(itertools.product(range(max(0, int(x0 // window_size_raw)), int(x1 // window_size_raw) + 1),
+                                           range(max(0, int(y0 // window_size_raw)), int(y1 // window_size_raw) + 1)))
+        print('Samples: %d samples on slide %s cover %d of %d windows' %
+              (len(samples), slide_name, len(cover.intersection(windows)), len(windows)))
+        windows = [w for w in windows if w in cover]
+
+    # Number of windows passed through WildCat in a single forward pass
+    batch_size = max(1, int(args.bsw))
+
+    # Read windows from the coarsest pyramid level that still has at least the input
+    # resolution required by every network, unless a level is specified
+    if args.read_level == 'auto':
+        read_level = choose_read_level(osl, min(net['patch_size_raw'] / input_size_wildcat for net in nets))
+    else:
+        read_level = int(args.read_level)
+    read_ds = osl.level_downsamples[read_level]
+    wl = int(round(wp / read_ds))
+    print('Reading windows from level %d (downsample %g)' % (read_level, read_ds))
+
+    # Preprocessing for each network: the padding to crop from the shared window (in
+    # pixels of the read level), and the residual resampling to the desired size of input
+    # to wildcat. All windows have the same size, so they can be stacked into a single
+    # batch tensor
+    crops = []
+    for net in nets:
+        crop_raw = padding_size_raw - net['padding_size_raw']
+        crop = int(round(crop_raw / read_ds))
+        wwc = int((wp - 2 * crop_raw) * input_size_wildcat / net['patch_size_raw'])
+        crops.append((crop, make_transform(wwc)))
+        net['input_size'] = wwc
+
+    # Skip the windows that contain no tissue
+    if args.tissue_mask is not None:
+        t_mask = compute_tissue_mask(osl, args.tissue_mask, args.tissue_threshold)
+        if t_mask is not None:
+            (mask, mask_pix, bg_color) = t_mask
+            tissue = [window_has_tissue(mask, mask_pix, w, window_size_raw, padding_size_raw) for w in windows]
+            skipped = [w for (w, t) in zip(windows, tissue) if not t]
+            windows = [w for (w, t) in zip(windows, tissue) if t]
+            print('Tissue mask: skipping %d of %d windows (%5.1f%%)' %
+                  (len(skipped), len(skipped) + len(windows),
+                   100.0 * len(skipped) / max(1, len(skipped) + len(windows))))
+
+            # Fill skipped windows with the network output on a blank window of glass color
+            blank_img = PIL.Image.new('RGB', (wl,wl), bg_color)
+            for (net, density, (crop, tran)) in zip(nets, densities, crops):
+                blank = torch.unsqueeze(tran(blank_img.crop((crop, crop, wl-crop, wl-crop))), dim=0)
+                p0,p1 = net['padding_size_out'],(net['padding_size_out']+net['window_size_out'])
+                bg_value = np.mean(apply_wildcat(net['forward'], blank, net['extra_shrinkage'])[0,:,p0:p1,p0:p1], axis=(1,2))
+                print('Background value: ', bg_value)
+                wout = net['window_size_out']
+                for (u,v) in skipped:
+                    density[:,v*wout:(v+1)*wout,u*wout:(u+1)*wout] = bg_value[:,np.newaxis,np.newaxis]
+
+    # Group the windows into batches. The grouping only depends on the list of windows,
+    # so a resumed run forms the same batches and skips those that were completed
+    batches = [windows[i:i+batch_size] for i in range(0, len(windows), batch_size)]
+    if win_done is not None:
+        batches = [b for b in batches if not all(win_done[u,v] for (u,v) in b)]
+
+    # Batches whose raw network outputs are all in the cache are written without being read.
+    # Batches with only some windows in the cache are processed whole, so the batches passed
+    # through the network are the same with and without the cache, and a resumed run matches
+    # an uninterrupted one. The raw outputs do not depend on the output resolution or on the
+    # region, so they can be reused when these change
+    cache = None
+    if args.cache is not None:
+        cache = open_window_cache(args.cache, args.cache_size)
+        fingerprint = slide_fingerprint(osl, args.slide)
+        for (net, (crop, _)) in zip(nets, crops):
+            net['cache_params'] = {
+                'slide': fingerprint, 'weights': file_sha1(net['weights']), 'backend': args.backend,
+                'window_size_raw': window_size_raw, 'padding_size_raw': padding_size_raw,
+                'read_level': read_level, 'crop': crop, 'input_size': net['input_size'] }
+
+        uncached = []
+        for batch_windows in batches:
+            hits = window_cache_get_batch(cache, nets, batch_windows)
+            if hits is None:
+                uncached.append(batch_windows)
+                continue
+            for ((u,v), k, x_cpool) in hits:
+                (net, density) = (nets[k], densities[k])
+                x_cpool_up = upsample_wildcat(torch.from_numpy(x_cpool[np.newaxis]), net['extra_shrinkage'])
+                p0,p1 = net['padding_size_out'],(net['padding_size_out']+net['window_size_out'])
+                wout = net['window_size_out']
+                density[:,v*wout:(v+1)*wout,u*wout:(u+1)*wout] = x_cpool_up[0,:,p0:p1,p0:p1]
+            if win_done is not None:
+                for (u,v) in batch_windows:
+                    win_done[u,v] = 1
+        if win_done is not None:
+            for density in densities:
+                density.flush()
+            win_done.flush()
+        print('Window cache: %d of %d batches found in %s' % (len(batches) - len(uncached), len(batches), args.cache))
+        batches = uncached
+    windows = [w for b in batches for w in b]
+
+    # Set up the readers. With no reader processes, a single thread reads and
+    # preprocesses the windows in the background
+    if args.readers > 0:
+        print('Reading windows with %d reader processes' % (args.readers,))
+        reader = iter_windows_pool(args.slide, windows, window_size_raw, padding_size_raw, read_level, crops,
+                                   args.readers, args.readers * 2 + batch_size)
+    else:
+        reader = iter_windows_thread(osl, windows, window_size_raw, padding_size_raw, read_level, crops,
+                                     batch_size + 4)
+
+    # Per-window timings, optionally written to a JSON lines file as they are collected
+    prof_records = []
+    prof_file = open(args.profile, 'wt') if args.profile is not None else None
+    if prof_file is not None:
+        prof_file.write(json.dumps({'slide': os.path.abspath(args.slide), 'network': args.network,
+                                    'backend': args.backend, 'bsw': batch_size, 'readers': args.readers,
+                                    'super_window': k_super,
+                                    'read_level': read_level, 'device': str(device), 'host': platform.node(),
+                                    'threads': torch.get_num_threads(), 'windows': len(windows)}) + '\n')
+
+    # Start the clock
+    t_00 = timeit.default_timer()
+
+    # Try/catch block to shut down the readers when done
     try:
 
-        # Range non-overlapping windows
-        while True:
-
-            # Get the coordinates of the window in raw pixels
-            x,y,w = u*window_size_raw,v*window_size_raw,window_size_raw
-
-            # Subtract the padding
-            xp,yp,wp = x-padding_size_raw,y-padding_size_raw,window_size_raw+2*padding_size_raw
+        # Process batches of non-overlapping windows
+        for batch_windows in batches:
 
-            # Read the chunk from the image
+            # Gather the windows in the batch from the readers, timing the wait for each
             t0 = timeit.default_timer()
-            q_data = chunk_q.get()
+            batch = []
+            for _ in batch_windows:
+                tq = timeit.default_timer()
+                item = next(reader, None)
+                if item is None:
+                    break
+                item[2]['queue_wait'] = timeit.default_timer() - tq
+                batch.append(item)
             t1 = timeit.default_timer()
 
-            # Check for sentinel value
-            if q_data is None:
-                break
-
-            # Get the values
-            ((x,y,w), (xp,yp,wp), chunk_img) = q_data
-
-            # Compute the desired size of input to wildcat
-            wwc = int(wp * input_size_wildcat / patch_size_raw)
-
-            # Resample the chunk for the two networks
-            tran = transforms.Compose([
-                transforms.Resize((wwc,wwc)),
-                transforms.ToTensor(),
-                transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
-            ])
+            # The reader stops early if it fails
+            if len(batch) < len(batch_windows):
+                raise Exception('Reader failed to read windows starting at (%d,%d)' % batch_windows[len(batch)])
 
-            # Convert the read chunk to tensor format
-            with torch.no_grad():
+            # Apply each network to the batch
+            batch_timings = {}
+            for k, (net, density) in enumerate(zip(nets, densities)):
 
-                # Apply transforms and turn into correct-size torch tensor
-                chunk_tensor=torch.unsqueeze(tran(chunk_img),dim=0).to(device)
+                # Stack the preprocessed windows into a single NxCxHxW tensor
+                chunk_tensor=torch.stack([chunks[k] for (_,chunks,_) in batch])
 
                 # Forward pass through the wildcat model
-                x_clas = model_wildcat.forward_to_classifier(chunk_tensor)
-                x_cpool = model_wildcat.spatial_pooling.class_wise(x_clas)
+                x_cpool = forward_wildcat(net['forward'], chunk_tensor, batch_timings)
 
-                # Scale the cpool image to desired size
-                x_cpool_up = torch.nn.functional.interpolate(x_cpool, scale_factor=1.0/extra_shrinkage).detach().cpu().numpy()
+                # Keep the raw output of each window for later runs
+                if cache is not None:
+                    x_raw = x_cpool.detach().cpu().numpy()
+                    for i, ((u,v), _, _) in enumerate(batch):
+                        window_cache_put(cache, window_cache_key(net['cache_params'], (u,v)), x_raw[i])
+
+                # Scale to the output size
+                x_cpool_up = upsample_wildcat(x_cpool, net['extra_shrinkage'], batch_timings)
 
                 # Extract the central portion of the output
-                p0,p1 = padding_size_out,(padding_size_out+window_size_out)
+                p0,p1 = net['padding_size_out'],(net['padding_size_out']+net['window_size_out'])
                 x_cpool_ctr = x_cpool_up[:,:,p0:p1,p0:p1]
 
-                # Stick it into the output array
-                xout0,xout1 = u * window_size_out, ((u+1) * window_size_out)
-                yout0,yout1 = v * window_size_out, ((v+1) * window_size_out)
-                density[0,xout0:xout1,yout0:yout1] = x_cpool_ctr[0,0,:,:].transpose()
-                density[1,xout0:xout1,yout0:yout1] = x_cpool_ctr[0,1,:,:].transpose()
-
-            # Finished first pass through the chunk
+                # Scatter the batch into the output array
+                wout = net['window_size_out']
+                for i, ((u,v), _, timings) in enumerate(batch):
+                    tc = timeit.default_timer()
+                    density[:,v*wout:(v+1)*wout,u*wout:(u+1)*wout] = x_cpool_ctr[i,:,:,:]
+                    timings['copy'] = timings.get('copy', 0.0) + timeit.default_timer() - tc
+
+            # Mark the batch as completed, after its results are on disk
+            if win_done is not None:
+                for density in densities:
+                    density.flush()
+                for (u,v) in batch_windows:
+                    win_done[u,v] = 1
+                win_done.flush()
+
+            # Finished first pass through the batch
             t2 = timeit.default_timer()
 
-            # At this point we have a list of hits for this chunk
-            print("Chunk: (%6d,%6d) Times: IO=%6.4f WldC=%6.4f Totl=%8.4f" %
-                  (u,v,t1-t0,t2-t1,t2-t0))
-
-        # Trim the density array to match size of input
-        out_dim_trim=np.round((slide_dim/out_pix_size)).astype(int)
-        density=density[:,0:out_dim_trim[0],0:out_dim_trim[1]]
+            # Record the timings of each window. The batch-level stages are split evenly
+            for ((u,v), _, timings) in batch:
+                rec = {'window': [u,v], 'batch': len(batch),
+                       'cells': int(np.prod(np.minimum(n_base_win, (np.array([u,v])+1)*k_super) -
+                                            np.array([u,v])*k_super))}
+                rec.update(timings)
+                for stage in ('forward', 'interpolate'):
+                    rec[stage] = batch_timings[stage] / len(batch)
+                prof_records.append(rec)
+                if prof_file is not None:
+                    prof_file.write(json.dumps(rec) + '\n')
+
+            # At this point we have a list of hits for this batch
+            (u,v) = batch[0][0]
+            print("Chunk: (%6d,%6d) Batch: %3d Times: IO=%6.4f WldC=%6.4f Totl=%8.4f" %
+                  (u,v,len(batch),t1-t0,t2-t1,t2-t0))
 
         # Report total time
         t_11 = timeit.default_timer()
@@ -256,34 +981,170 @@ def do_apply(args):
         sys.exit(-1)
 
     finally:
-        worker.join(60)
-        if worker.isAlive():
-            print('Thread worker failed to terminate after 60 seconds')
+        reader.close()
 
-    # Set the spacing based on openslide
     # Get the image spacing from the header, in mm units
-    (sx, sy) = (0.0, 0.0)
-    if 'openslide.mpp-x' in osl.properties:
-        sx = float(osl.properties['openslide.mpp-x']) * out_pix_size / 1000.0
-        sy = float(osl.properties['openslide.mpp-y']) * out_pix_size / 1000.0
-    elif 'openslide.comment' in osl.properties:
-        for z in osl.properties['openslide.comment'].split('\n'):
-            r = parse.parse('Resolution = {} um', z)
-            if r is not None:
-                sx = float(r[0]) * out_pix_size / 1000.0
-                sy = float(r[0]) * out_pix_size / 1000.0
+    (sx, sy) = get_slide_spacing(osl)
 
-    # If there is no spacing, throw exception
-    if sx == 0.0 or sy == 0.0:
-      raise Exception('No spacing information in image')
+    # Write each density map and the burden statistics of the samples
+    burden_rows = []
+    for (k, (net, density)) in enumerate(zip(nets, densities)):
 
-    # Report spacing information
-    print("Spacing of the mri-like image: %gx%gmm\n" % (sx, sy))
+        # Trim the density array to match size of input
+        out_pix_size = net['out_pix_size']
+        out_dim_trim=np.round((slide_dim/out_pix_size)).astype(int)
+        density=density[:,0:out_dim_trim[1],0:out_dim_trim[0]]
+
+        # Burden statistics in each sample
+        if args.burden is not None:
+            for (row, (burden, max_sliding)) in zip(samples, sample_burden(density, slide_dim, samples,
+                                                                          args.mean_filter_size)):
+                burden_rows.append({
+                    'id': row['id'], 'specimen': row['specimen_name'], 'block': row['block_name'],
+                    'slide_name': row['slide_name'], 'label': row['label_name'], 'network': net['network'],
+                    'mean_burden': burden, 'max_sliding_burden': max_sliding })
+                print('%s\t%s\t%6.4f\t%6.4f' % (row['slide_name'], row['label_name'], burden, max_sliding))
+
+        # Without an output, only the burden statistics are computed
+        if args.output is None:
+            continue
+        output = args.output[k]
+
+        # Report spacing information
+        print("Spacing of the density map for %s: %gx%gmm\n" %
+              (net['network'], sx * out_pix_size, sy * out_pix_size))
+
+        # Write the result as a multi-resolution store or as a NIFTI file
+        if output.endswith('.zarr'):
+            from density_pyramid import write_density_pyramid
+            write_density_pyramid(output, density, (sx * out_pix_size, sy * out_pix_size))
+        else:
+            write_nifti_strips(output, density, (sx * out_pix_size, sy * out_pix_size))
+
+    # Export the burden statistics as CSV
+    if args.burden is not None:
+        with open(args.burden, 'wt', newline='') as fp:
+            writer = csv.DictWriter(fp, fieldnames=['id', 'specimen', 'block', 'slide_name', 'label', 'network',
+                                                    'mean_burden', 'max_sliding_burden'])
+            writer.writeheader()
+            writer.writerows(burden_rows)
+
+    # The checkpoint or scratch space is no longer needed once the outputs are written
+    del densities, density
+    if args.checkpoint is not None:
+        remove_checkpoint(args.checkpoint, len(nets))
+    else:
+        scratch.cleanup()
+
+    # Report cache use
+    if cache is not None:
+        print('Window cache: %d hits, %d misses, %d windows (%.2f GB) stored' %
+              (cache['hits'], cache['misses'], len(cache['lru']), cache['size'] / 2.0**30))
+
+    # Report memory use
+    peak_rss = report_peak_rss()
+
+    # Summarize the profile
+    summary = profile_summary(prof_records, t_11-t_00, peak_rss)
+    print("Throughput: %8.3f windows/sec (%8.3f windows/sec of size %d)" %
+          (summary['windows_per_sec'], summary['cells_per_sec'], window_size_raw // k_super))
+    for stage in profile_stages:
+        print("  %-12s total=%9.3f  p50=%7.4f  p90=%7.4f  p99=%7.4f  max=%7.4f" %
+              ((stage,) + tuple(summary[stage][q] for q in ('total', 'p50', 'p90', 'p99', 'max'))))
+    if prof_file is not None:
+        prof_file.write(json.dumps({'summary': summary}) + '\n')
+        prof_file.close()
+
+
+# Compare the density maps computed by the eager model and by an exported model on
+# sample windows of a slide, and report the deviation between them
+def validate_export(network, export_dir, slide, n_windows):
+
+    # Load both versions of the network
+    with open(os.path.join(export_dir, 'export.json')) as json_file:
+        cf_export=json.load(json_file)
+    nets = [load_network(network), load_network(export_dir, cf_export['format'])]
+    net = nets[0]
+
+    # Pick windows evenly spread over the tissue (or the whole slide if there is no mask)
+    osl=openslide.OpenSlide(slide)
+    window_size_raw, padding_size_raw = net['window_size_raw'], net['padding_size_raw']
+    n_win = np.ceil(np.array(osl.dimensions) / window_size_raw).astype(int)
+    windows = [(u,v) for u in range(n_win[0]) for v in range(n_win[1])]
+    t_mask = compute_tissue_mask(osl, 'slide', 15)
+    if t_mask is not None:
+        (mask, mask_pix, _) = t_mask
+        windows = [w for w in windows if window_has_tissue(mask, mask_pix, w, window_size_raw, padding_size_raw)]
+    windows = [windows[i] for i in np.unique(np.linspace(0, len(windows)-1, n_windows).astype(int))]
+
+    # Read and preprocess the windows the same way as apply
+    level = choose_read_level(osl, net['patch_size_raw'] / input_size_wildcat)
+    wp = window_size_raw + 2 * padding_size_raw
+    crops = [(0, make_transform(int(wp * input_size_wildcat / net['patch_size_raw'])))]
+    p0,p1 = net['padding_size_out'],(net['padding_size_out']+net['window_size_out'])
+
+    # Compute the density maps with both backends
+    dev = []
+    for window in windows:
+        chunks, _ = read_window(osl, window, window_size_raw, padding_size_raw, level, crops)
+        chunk_tensor = torch.unsqueeze(chunks[0], dim=0)
+        d = [apply_wildcat(n['forward'], chunk_tensor, n['extra_shrinkage'])[0,:,p0:p1,p0:p1] for n in nets]
+        dev.append(np.abs(d[0] - d[1]))
+        print('Window (%d,%d): max deviation %g' % (window[0], window[1], np.max(dev[-1])))
+
+    dev = np.stack(dev)
+    print('Validation on %d windows: max deviation %g, mean deviation %g' % (len(windows), np.max(dev), np.mean(dev)))
+
+
+# Export a trained network into a directory with an optimized model for CPU inference
+def do_export(args):
+
+    # Export happens on the CPU
+    global device
+    device = torch.device('cpu')
+
+    # Load the trained network
+    net = load_network(args.network)
+    module = net['module'].eval()
+
+    # Example input: a batch of padded windows at the network input size
+    wp = net['window_size_raw'] + 2 * net['padding_size_raw']
+    wwc = int(wp * input_size_wildcat / net['patch_size_raw'])
+    example = torch.rand(args.bsw, 3, wwc, wwc)
+
+    # The exported directory carries its own copy of the config
+    os.makedirs(args.output, exist_ok=True)
+    shutil.copy(os.path.join(args.network, 'config.json'), args.output)
+
+    with torch.no_grad():
+        if args.format == 'torchscript':
+            if args.quantize:
+                raise Exception('Dynamic quantization is only supported for onnx exports')
+            fn = 'wildcat_classwise.pt'
+            ts_module = torch.jit.optimize_for_inference(torch.jit.freeze(torch.jit.trace(module, example)))
+            ts_module.save(os.path.join(args.output, fn))
+        else:
+            fn = 'wildcat_classwise.onnx'
+            torch.onnx.export(module, example, os.path.join(args.output, fn),
+                              input_names=['input'], output_names=['cpool'], opset_version=13,
+                              dynamic_axes={'input': {0: 'batch'}, 'cpool': {0: 'batch'}})
 
-    # Write the result as a NIFTI file
-    nii = sitk.GetImageFromArray(np.transpose(density, (2,1,0)), True)
-    nii.SetSpacing((sx, sy))
-    sitk.WriteImage(nii, args.output)
+            # Dynamic quantization stores the weights as int8
+            if args.quantize:
+                from onnxruntime.quantization import quantize_dynamic, QuantType
+                fn_fp32, fn = fn, 'wildcat_classwise_int8.onnx'
+                quantize_dynamic(os.path.join(args.output, fn_fp32), os.path.join(args.output, fn),
+                                 weight_type=QuantType.QInt8)
+
+    # Describe the exported model
+    with open(os.path.join(args.output, 'export.json'), 'wt') as fp:
+        json.dump({'format': args.format, 'file': fn, 'quantized': args.quantize,
+                   'source': os.path.abspath(args.network)}, fp)
+    print('Exported %s model to %s' % (args.format, os.path.join(args.output, fn)))
+
+    # Compare to the eager model
+    if args.validate is not None:
+        validate_export(args.network, args.output, args.validate, args.validate_windows)
 
 
 # Set up an argument parser
@@ -294,13 +1155,65 @@ train_parser = subparsers.add_parser('train')
 
 apply_parser = subparsers.add_parser('apply')
 apply_parser.add_argument('--slide', help='Input histology slide to process')
-apply_parser.add_argument('--output', help='Where to store the output density map')
-apply_parser.add_argument('--network', help='Network saved during training')
-apply_parser.add_argument('--bsr', help='Batch size for ResNet', default=8)
-apply_parser.add_argument('--bsw', help='Batch size for WildCat', default=8)
+apply_parser.add_argument('--output', help='Where to store the output density map (one per network). Outputs '
+                          'ending in .zarr are written as multi-resolution stores (see density_pyramid.py)', nargs='+')
+apply_parser.add_argument('--network', help='Network saved during training. Several networks can be '
+                          'applied in a single pass over the slide', nargs='+')
+apply_parser.add_argument('--bsr', help='Batch size for ResNet', type=int, default=8)
+apply_parser.add_argument('--bsw', help='Batch size for WildCat (windows per forward pass)', type=int, default=8)
+apply_parser.add_argument('--readers', help='Number of reader processes (0 to read in a background thread)',
+                          type=int, default=0)
+apply_parser.add_argument('--tissue-mask', help='Skip windows without tissue, using a mask computed from '
+                          'a low-resolution level of the slide (slide) or from an RGB NIfTI image such as '
+                          '*_rgb_40um.nii.gz', metavar='slide|image.nii.gz')
+apply_parser.add_argument('--tissue-threshold', help='Minimum color saturation (0-255) of tissue pixels',
+                          type=int, default=15)
+apply_parser.add_argument('--checkpoint', help='Directory where partial results are kept, so that an '
+                          'interrupted run on the same slide, network and output resumes where it stopped')
+apply_parser.add_argument('--dtype', help='Data type of the density accumulator. The output is always float32',
+                          choices=['float32', 'float16'], default='float32')
+apply_parser.add_argument('--cache', help='Directory where the raw network output of each window is cached, '
+                          'so that reruns on the same slide only process windows that are not in the cache')
+apply_parser.add_argument('--cache-size', help='Maximum size of the window cache in GB. The least recently '
+                          'used windows are evicted first', type=float, default=50.0)
+apply_parser.add_argument('--read-level', help='Pyramid level to read windows from. By default, the coarsest '
+                          'level that meets the input resolution of the networks. Use 0 to read at full resolution. '
+                          'wildcat_bench.py --check-read-level checks that the two agree',
+                          default='auto')
+apply_parser.add_argument('--backend', help='How to run the networks: eager PyTorch on the directories saved '
+                          'during training, or models created by the export command',
+                          choices=['eager', 'torchscript', 'onnx'], default='eager')
+apply_parser.add_argument('--profile', help='Write per-window timings of each processing stage, followed by '
+                          'a summary, to this JSON lines file')
+apply_parser.add_argument('--super-window', help='Process blocks of k x k windows in a single pass so that '
+                          'neighbouring windows share their padding. Needs k*k times more memory per window. '
+                          'Outputs may differ slightly from per-window padding; wildcat_bench.py --super-windows '
+                          'measures the difference and checks it against a limit (by default 0.05 max and 0.005 '
+                          'mean absolute difference in class probability)',
+                          type=int, default=1, metavar='k')
 apply_parser.add_argument('--region', help='Region of image to process (x,y,w,h)', nargs=4)
+apply_parser.add_argument('--samples', help='Only process the windows covering the samples drawn on this slide '
+                          'in a HistoAnnot sample manifest (see integrate_density_over_samples.py)', metavar='manifest')
+apply_parser.add_argument('--slide-name', help='Name of the slide in the sample manifest (default: slide '
+                          'filename without extension)')
+apply_parser.add_argument('--stain', help='Only use samples of this stain from the sample manifest')
+apply_parser.add_argument('--burden', help='Write burden statistics of the samples to this CSV file', metavar='result')
+apply_parser.add_argument('--mean-filter-size', help='Size of the sliding window used for the max sliding burden, '
+                          'in raw histology image pixels', type=int, default=512)
 apply_parser.set_defaults(func=do_apply)
 
+export_parser = subparsers.add_parser('export')
+export_parser.add_argument('--network', help='Network saved during training', required=True)
+export_parser.add_argument('--output', help='Directory where to store the exported network', required=True)
+export_parser.add_argument('--format', help='Format of the exported model', choices=['torchscript', 'onnx'],
+                           default='torchscript')
+export_parser.add_argument('--quantize', help='Apply dynamic int8 quantization (onnx only)', action='store_true')
+export_parser.add_argument('--bsw', help='Batch size of the example input used for export', type=int, default=8)
+export_parser.add_argument('--validate', help='Compare the exported model to the original on sample windows '
+                           'from this slide', metavar='slide')
+export_parser.add_argument('--validate-windows', help='Number of windows used for validation', type=int, default=16)
+export_parser.set_defaults(func=do_export)
+
 info_parser = subparsers.add_parser('info')
 info_parser.set_defaults(func=do_info)
 
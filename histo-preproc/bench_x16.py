@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+# Compare the runtime and peak memory of the ways process_raw_slide.py can hold the
+# x16 level (--x16-mode), on a synthetic slide that is generated once. Each mode runs
+# in its own process, and its peak RSS is taken from the resource use of that process
+from __future__ import print_function
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+# The synthetic slide generator is shared with histo-burden/wildcat_bench.py
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from synthetic_slide import make_synthetic_slide
+
+
+# Run process_raw_slide.py with the given mode, returning wall time and peak RSS in MB
+def run_mode(slide, prefix, mode):
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'process_raw_slide.py'),
+           '-m', '-i', slide, '-s', prefix, '--x16-mode', mode]
+    print(' '.join(cmd))
+    t0 = time.time()
+    proc = subprocess.Popen(cmd)
+    (_, status, rusage) = os.wait4(proc.pid, 0)
+    t1 = time.time()
+    if status != 0:
+        raise Exception('process_raw_slide.py failed in %s mode' % (mode,))
+    return t1 - t0, rusage.ru_maxrss / 1024.0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark x16 pyramid generation in process_raw_slide.py')
+    parser.add_argument('--workdir', default='bench_x16', help='Directory for the synthetic slide and outputs')
+    parser.add_argument('--slide-size', type=int, nargs=2, default=(160000, 120000),
+                        help='Size of the synthetic slide in pixels')
+    parser.add_argument('--mpp', type=float, default=0.25, help='Pixel size of the synthetic slide, in microns')
+    parser.add_argument('--modes', nargs='+', default=['memory', 'stream'], help='Values of --x16-mode')
+    args = parser.parse_args()
+
+    os.makedirs(args.workdir, exist_ok=True)
+    slide = os.path.join(args.workdir, 'synthetic_%dx%d.tiff' % tuple(args.slide_size))
+    if not os.path.exists(slide):
+        print('Generating synthetic slide %s' % (slide,))
+        make_synthetic_slide(slide, args.slide_size[0], args.slide_size[1], args.mpp)
+
+    results = [(mode,) + run_mode(slide, os.path.join(args.workdir, mode), mode) for mode in args.modes]
+
+    print('%-8s %10s %12s' % ('mode', 'time (s)', 'RSS (MB)'))
+    for (mode, t, rss) in results:
+        print('%-8s %10.2f %12.1f' % (mode, t, rss))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+# Build a tiled BigTIFF pyramid that OpenSlide reads as an Aperio slide from a flat
+# (single-level) TIFF, such as a Huron scan. Level 0 is stored with lossless deflate
+# compression, so no detail of the scan is lost, and the reduced levels with JPEG.
+# The original description is kept after the Aperio header. Level 0 is read in
+# strips of rows, and each strip is written out as tiles and also downsampled into
+# the next level, which is kept in a memory-mapped temporary file. Each level is then
+# written the same way from the previous one. Reading and downsampling of strips run
+# in a thread pool ahead of the writer, and tifffile compresses tiles in parallel, so
+# memory use is bounded by a few strips regardless of the size of the slide
+from __future__ import print_function
+import os
+import sys
+import argparse
+import tempfile
+import collections
+import concurrent.futures
+import numpy as np
+import tifffile
+import zarr
+from fixup_huron import verify_aperio
+
+
+# Reduce a strip of an RGB image by averaging blocks of ds x ds pixels. The strip is
+# padded by repeating its last row and column to a multiple of ds
+def downsample_strip(strip, ds):
+    (h, w) = strip.shape[0:2]
+    (hp, wp) = (-h % ds, -w % ds)
+    if hp or wp:
+        strip = np.pad(strip, ((0, hp), (0, wp), (0, 0)), mode='edge')
+    s = strip.reshape(strip.shape[0] // ds, ds, strip.shape[1] // ds, ds, 3).sum(axis=(1, 3), dtype=np.uint32)
+    return ((s + ds * ds // 2) // (ds * ds)).astype(np.uint8)
+
+
+# Read rows y0:y1 of a level, and store their downsampled version in the next level
+def load_strip(src, y0, y1, dst, ds):
+    strip = np.ascontiguousarray(src[y0:y1, :, 0:3])
+    if dst is not None:
+        small = downsample_strip(strip, ds)
+        dst[y0 // ds:y0 // ds + small.shape[0], :, :] = small
+    return strip
+
+
+# Generate the tiles of a level in row-major order, as expected by tifffile. Strips
+# are loaded by the thread pool a few strips ahead of the writer. Edge tiles are
+# padded to the full tile size
+def iter_level_tiles(src, shape, tile_size, dst, ds, executor, prefetch=4):
+    (h, w) = shape
+    starts = list(range(0, h, tile_size))
+    futures = collections.deque()
+    for (i, y0) in enumerate(starts):
+        while len(futures) < prefetch and len(futures) + i < len(starts):
+            y = starts[i + len(futures)]
+            futures.append(executor.submit(load_strip, src, y, min(h, y + tile_size), dst, ds))
+        strip = futures.popleft().result()
+        if strip.shape[0] < tile_size:
+            strip = np.pad(strip, ((0, tile_size - strip.shape[0]), (0, 0), (0, 0)), mode='edge')
+        for x0 in range(0, w, tile_size):
+            tile = strip[:, x0:x0 + tile_size, :]
+            if tile.shape[1] < tile_size:
+                tile = np.pad(tile, ((0, 0), (0, tile_size - tile.shape[1]), (0, 0)), mode='edge')
+            yield tile
+
+
+# Get the pixel size in microns from the resolution tags of a TIFF page, or None
+def get_page_mpp(page):
+    tags = page.tags
+    if 'XResolution' not in tags or 'ResolutionUnit' not in tags:
+        return None
+    (num, den) = tags['XResolution'].value
+    unit = {2: 25400.0, 3: 10000.0}.get(int(tags['ResolutionUnit'].value))
+    if unit is None or num == 0:
+        return None
+    return unit * den / num
+
+
+def build_pyramid(fn_input, fn_output, tile_size=256, quality=90, ds=4, min_size=1024, workers=None, tmpdir=None):
+    workers = workers or os.cpu_count()
+    with tifffile.TiffFile(fn_input) as tif:
+        page = tif.pages[0]
+        src = zarr.open(page.aszarr(), mode='r')
+        mpp = get_page_mpp(page)
+        desc_orig = page.description
+
+        # Sizes of the levels, reduced by ds until the level fits in min_size
+        shapes = [tuple(page.shape[0:2])]
+        while max(shapes[-1]) > min_size:
+            (h, w) = shapes[-1]
+            shapes.append(((h + ds - 1) // ds, (w + ds - 1) // ds))
+
+        # The reduced levels are accumulated in memory-mapped temporary files
+        tmp = tempfile.TemporaryDirectory(dir=tmpdir)
+        levels = [src] + [np.lib.format.open_memmap(os.path.join(tmp.name, 'level_%d.npy' % k), mode='w+',
+                                                    dtype=np.uint8, shape=shape + (3,))
+                          for (k, shape) in enumerate(shapes) if k > 0]
+
+        # Description that makes OpenSlide read the file as Aperio, followed by the original
+        # description. The MPP becomes the openslide.mpp-x/y properties
+        (h0, w0) = shapes[0]
+        desc0 = 'Aperio Image Library v1.0 (build_pyramid.py)\r\n%dx%d [0,0 %dx%d] (%dx%d) Deflate/RGB' % (
+            w0, h0, w0, h0, tile_size, tile_size)
+        if desc_orig:
+            desc0 += '\r\n' + desc_orig
+        if mpp is not None:
+            desc0 += '|MPP = %g' % (mpp,)
+
+        with tifffile.TiffWriter(fn_output, bigtiff=True) as tw, \
+                concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            for (k, shape) in enumerate(shapes):
+                print('Writing level %d: %dx%d' % (k, shape[1], shape[0]))
+                dst = levels[k + 1] if k + 1 < len(levels) else None
+                extra = {'resolution': (1e4 / mpp, 1e4 / mpp), 'resolutionunit': 'CENTIMETER'} \
+                    if k == 0 and mpp is not None else {}
+                comp = {'compression': 'zlib'} if k == 0 else \
+                    {'compression': 'jpeg', 'compressionargs': {'level': quality}}
+                tw.write(iter_level_tiles(levels[k], shape, tile_size, dst, ds, executor),
+                         shape=shape + (3,), dtype=np.uint8, tile=(tile_size, tile_size), photometric='rgb',
+                         description=desc0 if k == 0 else 'Aperio Image Library v1.0 (build_pyramid.py)',
+                         subfiletype=0 if k == 0 else 1, metadata=None, maxworkers=workers, **comp, **extra)
+                if dst is not None:
+                    dst.flush()
+
+        del levels, dst
+        tmp.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build an Aperio-compatible pyramid from a flat TIFF')
+    parser.add_argument('input', help='Flat (single-level) TIFF')
+    parser.add_argument('output', help='Output pyramid, readable by OpenSlide as an Aperio slide')
+    parser.add_argument('--tile-size', type=int, default=256, help='Size of the tiles, in pixels')
+    parser.add_argument('--quality', type=int, default=90, help='JPEG quality of the reduced levels')
+    parser.add_argument('--downsample', type=int, default=4, help='Downsampling factor between levels')
+    parser.add_argument('--min-size', type=int, default=1024,
+                        help='Add levels until the largest dimension is no more than this')
+    parser.add_argument('--threads', type=int, help='Number of threads (default: all CPUs)')
+    parser.add_argument('--tmpdir', help='Directory for the temporary downsampled levels')
+    parser.add_argument('--verify', action='store_true',
+                        help='Check that OpenSlide opens the result as an Aperio slide')
+    args = parser.parse_args()
+
+    if args.tile_size % args.downsample:
+        parser.error('The tile size must be a multiple of the downsampling factor')
+
+    build_pyramid(args.input, args.output, args.tile_size, args.quality, args.downsample,
+                  args.min_size, args.threads, args.tmpdir)
+    if args.verify:
+        verify_aperio(args.output)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,31 @@
-#!/usr/bin/env python 
-import bitstring as bs
+#!/usr/bin/env python
 import sys
+import os
 import argparse
+import mmap
+import struct
+import shutil
+import fcntl
 
 # Define arguments
-parser = argparse.ArgumentParser()
+parser = argparse.ArgumentParser(
+    description='Make a Huron TIFF readable as Aperio SVS by prefixing its ImageDescription')
 parser.add_argument('input')
-parser.add_argument('output')
-args = parser.parse_args()
+parser.add_argument('output', nargs='?',
+                    help='Output file. Not used with --in-place')
+parser.add_argument('--in-place', action='store_true',
+                    help='Patch the input file instead of writing a new file')
+parser.add_argument('--method', choices=['fast', 'bitstring'], default='fast',
+                    help='Parse the TIFF with mmap and struct and copy it in the kernel (fast), or '
+                         'rewrite it through bitstring (the original implementation)')
+parser.add_argument('--verify', action='store_true',
+                    help='Check that OpenSlide opens the result as an Aperio slide')
+
+# Prefix that makes OpenSlide detect the file as Aperio
+desc_prefix = b'Aperio SVS generated from Huron Digital Pathology TIF\n'
+
+# The ioctl that clones the extents of a file (a reflink) on btrfs, xfs and others
+FICLONE = 0x40049409
 
 def write_bytes(src, dest, n, stride=64 * 1048576):
     print('Writing %4.1fGb chunk. Each dot is %4.1fMb' % (n / 1024.**3, stride / 1024.**2))
@@ -19,81 +37,212 @@ def write_bytes(src, dest, n, stride=64 * 1048576):
     sys.stdout.write('\n')
 
 
-# Create bitstream
-s = bs.ConstBitStream(filename=args.input)
-
-# Read the endianness and assign tags
-code_format = s.read('hex:16')
-if code_format == '4949':
-    u16,u32,u64 = 'uintle:16', 'uintle:32', 'uintle:64'
-elif code_format == '4d4d':
-    u16,u32,u64 = 'uintbe:16', 'uintbe:32', 'uintbe:64'
-else:
-    raise Exception('Not a valid TIFF file')
-
-# Read the format (Tiff or BigTiff)
-code_version = s.read(u16)
-if code_version == 42:
-    addr_size = 4
-    uaddr = u32
-    utags = u16
-    taglen = 12
-    s.bytepos = 4
-elif code_version == 43:
-    addr_size = 8
-    uaddr = u64
-    utags = u64
-    taglen = 20
-    s.bytepos = 8
-else:
-    raise Exception('Not a valid TIFF file')
-
-# Array of description offsets and lenghs
-desc = []
-
-# Read the offset to IFD
-ifd_offset = s.read(uaddr)
-while ifd_offset > 0:
-    s.bytepos = ifd_offset
-    n_tags = s.read(utags)
-    for i in range(n_tags):
-        tpos = s.bytepos
-        tag = s.read(u16)
-        tag_type = s.read(u16)
-        nval = s.read(uaddr)
-        offset = s.read(uaddr)
-        # print('tag: ', tag, tag_type, nval, offset)
-        if tag == 270:
-            desc.append((tpos, nval, offset))
+# Original implementation, which reads the TIFF through bitstring and writes the
+# output with the description tag replaced and the new description appended
+def fixup_bitstring(fn_input, fn_output):
+    import bitstring as bs
+
+    # Create bitstream
+    s = bs.ConstBitStream(filename=fn_input)
+
+    # Read the endianness and assign tags
+    code_format = s.read('hex:16')
+    if code_format == '4949':
+        u16,u32,u64 = 'uintle:16', 'uintle:32', 'uintle:64'
+    elif code_format == '4d4d':
+        u16,u32,u64 = 'uintbe:16', 'uintbe:32', 'uintbe:64'
+    else:
+        raise Exception('Not a valid TIFF file')
 
+    # Read the format (Tiff or BigTiff)
+    code_version = s.read(u16)
+    if code_version == 42:
+        addr_size = 4
+        uaddr = u32
+        utags = u16
+        taglen = 12
+        s.bytepos = 4
+    elif code_version == 43:
+        addr_size = 8
+        uaddr = u64
+        utags = u64
+        taglen = 20
+        s.bytepos = 8
+    else:
+        raise Exception('Not a valid TIFF file')
+
+    # Array of description offsets and lenghs
+    desc = []
+
+    # Read the offset to IFD
     ifd_offset = s.read(uaddr)
+    while ifd_offset > 0:
+        s.bytepos = ifd_offset
+        n_tags = s.read(utags)
+        for i in range(n_tags):
+            tpos = s.bytepos
+            tag = s.read(u16)
+            tag_type = s.read(u16)
+            nval = s.read(uaddr)
+            offset = s.read(uaddr)
+            # print('tag: ', tag, tag_type, nval, offset)
+            if tag == 270:
+                desc.append((tpos, nval, offset))
+
+        ifd_offset = s.read(uaddr)
+
+    # The tag we will be changing
+    tpos, nval, offset = desc[0]
+    s.bytepos = offset
+    desc = s.peek('bytes:%d' % (nval,))
+    # print(desc)
+
+    # Open output file for writing
+    of = open(fn_output, 'wb')
+
+    # Write everything up to the first desc tag
+    s.bytepos = 0
+    write_bytes(s, of, tpos)
+
+    # Override the new tag
+    desc_new = desc_prefix + desc
+    t = bs.BitArray()
+    t.append('%s=%d' % (u16, 270))
+    t.append('%s=%d' % (u16, 2))
+    t.append('%s=%d' % (uaddr, len(desc_new)))
+    t.append('%s=%d' % (uaddr, len(s) // 8))
+    of.write(t.bytes)
+
+    # Skip the length of the tag
+    s.bytepos += taglen
+    write_bytes(s, of, len(s) // 8 - s.bytepos)
+
+    # Write the new description
+    of.write(desc_new)
+    of.close()
+
+
+# Find the first ImageDescription tag of a TIFF or BigTIFF file. Returns the struct
+# byte order and address format, the position of the tag entry in the file, and the
+# current description
+def find_description(fn):
+    with open(fn, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+
+        # Read the endianness and the format (Tiff or BigTiff)
+        bo = {b'II': '<', b'MM': '>'}.get(mm[0:2])
+        if bo is None:
+            raise Exception('Not a valid TIFF file')
+        (code_version,) = struct.unpack_from(bo + 'H', mm, 2)
+        if code_version == 42:
+            (ua, ut, pos) = ('I', 'H', 4)
+        elif code_version == 43:
+            (ua, ut, pos) = ('Q', 'Q', 8)
+        else:
+            raise Exception('Not a valid TIFF file')
+        (sa, st) = (struct.calcsize(ua), struct.calcsize(ut))
+        taglen = 4 + 2 * sa
+
+        # Walk the chain of IFDs
+        (ifd_offset,) = struct.unpack_from(bo + ua, mm, pos)
+        while ifd_offset > 0:
+            (n_tags,) = struct.unpack_from(bo + ut, mm, ifd_offset)
+            for i in range(n_tags):
+                tpos = ifd_offset + st + i * taglen
+                (tag, tag_type, nval) = struct.unpack_from(bo + 'HH' + ua, mm, tpos)
+                if tag == 270:
+                    # Short descriptions are stored in the entry itself
+                    if nval <= sa:
+                        desc = mm[tpos + 4 + sa:tpos + 4 + sa + nval]
+                    else:
+                        (offset,) = struct.unpack_from(bo + ua, mm, tpos + 4 + sa)
+                        desc = mm[offset:offset + nval]
+                    return bo, ua, tpos, desc
+            (ifd_offset,) = struct.unpack_from(bo + ua, mm, ifd_offset + st + n_tags * taglen)
+
+    raise Exception('No ImageDescription tag in %s' % (fn,))
+
+
+# Copy a file without passing the data through Python: clone it if the file system
+# supports reflinks, otherwise copy in the kernel with copy_file_range or sendfile
+def copy_file_kernel(fn_input, fn_output):
+    with open(fn_input, 'rb') as fi, open(fn_output, 'wb') as fo:
+        try:
+            fcntl.ioctl(fo.fileno(), FICLONE, fi.fileno())
+            return 'reflink'
+        except OSError:
+            pass
+
+        n = os.fstat(fi.fileno()).st_size
+        for (method, fn_copy) in (('copy_file_range', getattr(os, 'copy_file_range', None)),
+                                  ('sendfile', os.sendfile)):
+            if fn_copy is None:
+                continue
+            try:
+                pos = 0
+                while pos < n:
+                    if method == 'sendfile':
+                        k = fn_copy(fo.fileno(), fi.fileno(), pos, n - pos)
+                    else:
+                        k = fn_copy(fi.fileno(), fo.fileno(), n - pos, pos, pos)
+                    if k == 0:
+                        break
+                    pos += k
+                if pos == n:
+                    return method
+            except OSError:
+                pass
+            fo.seek(0)
+            fo.truncate()
+
+        shutil.copyfileobj(fi, fo, 64 * 1048576)
+        return 'copy'
+
+
+# Patch a file in place: append the new description at the end of the file (aligned
+# to a word boundary) and rewrite the tag entry to point to it
+def patch_description(fn, bo, ua, tpos, desc):
+    desc_new = desc_prefix + desc
+    with open(fn, 'r+b') as f:
+        end = f.seek(0, os.SEEK_END)
+        offset = end + (end % 2)
+        if ua == 'I' and offset + len(desc_new) >= 2**32:
+            raise Exception('Classic TIFF cannot address a description past 4GB')
+        f.write(b'\0' * (offset - end) + desc_new)
+        f.seek(tpos)
+        f.write(struct.pack(bo + 'HH' + ua + ua, 270, 2, len(desc_new), offset))
+
+
+def fixup_fast(fn_input, fn_output, in_place):
+    (bo, ua, tpos, desc) = find_description(fn_input)
+    if desc.startswith(desc_prefix):
+        print('%s already has an Aperio description' % (fn_input,))
+        if not in_place:
+            copy_file_kernel(fn_input, fn_output)
+        return
+    if not in_place:
+        print('Copied %s to %s using %s' % (fn_input, fn_output, copy_file_kernel(fn_input, fn_output)))
+    patch_description(fn_input if in_place else fn_output, bo, ua, tpos, desc)
+
+
+# Check that OpenSlide detects the result as an Aperio slide
+def verify_aperio(fn):
+    import openslide
+    vendor = openslide.OpenSlide.detect_format(fn)
+    if vendor != 'aperio':
+        raise Exception('OpenSlide detects %s as %s, not aperio' % (fn, vendor))
+    slide = openslide.OpenSlide(fn)
+    print('Verified %s: aperio, %d levels, %dx%d' % ((fn, slide.level_count) + slide.dimensions))
+
 
-# The tag we will be changing
-tpos, nval, offset = desc[0]
-s.bytepos = offset
-desc = s.peek('bytes:%d' % (nval,))
-# print(desc)
-
-# Open output file for writing
-of = open(args.output, 'wb')
-
-# Write everything up to the first desc tag
-s.bytepos = 0
-write_bytes(s, of, tpos)
-
-# Override the new tag
-desc_new = b'Aperio SVS generated from Huron Digital Pathology TIF\n' + desc
-t = bs.BitArray()
-t.append('%s=%d' % (u16, 270))
-t.append('%s=%d' % (u16, 2))
-t.append('%s=%d' % (uaddr, len(desc_new)))
-t.append('%s=%d' % (uaddr, len(s) / 8))
-of.write(t.bytes)
-
-# Skip the length of the tag
-s.bytepos += 20
-write_bytes(s, of, len(s) // 8 - s.bytepos)
-
-# Write the new description
-of.write(desc_new)
-of.close()
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if args.in_place == (args.output is not None):
+        parser.error('Specify either an output file or --in-place')
+    if args.method == 'bitstring':
+        if args.in_place:
+            parser.error('--in-place requires --method fast')
+        fixup_bitstring(args.input, args.output)
+    else:
+        fixup_fast(args.input, args.output, args.in_place)
+    if args.verify:
+        verify_aperio(args.input if args.in_place else args.output)
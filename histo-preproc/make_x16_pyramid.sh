@@ -12,6 +12,10 @@ gcloud config set project cfn-cluster-test
 RAWBASE="gs://mtl_histology/$id/histo_raw"
 PREPROCBASE="gs://mtl_histology/$id/histo_proc/$svs/preproc"
 
+# Mid-resolution images
+MIDRES_PNG=./data/${svs}_x16.png
+MIDRES_PTIFF=./data/${svs}_x16_pyramid.tiff
+
 # Locate the x16 PNG
 if pngfile=$(gsutil ls "$PREPROCBASE/${svs}_x16.png"); then
   echo "x16 PNG file found for $id $svs"
@@ -24,25 +28,24 @@ elif svsfile=$(gsutil ls "$RAWBASE/${svs}.*"); then
   svslocal=$(ls ./data/${svs}.{tiff,tif,svs} || true)
   echo "svslocal=$svslocal"
 
-  # Extract a thumbnail and a 40um resolution image
-  ./process_raw_slide.py -m -i $svslocal -s ./data/${svs}
+  # Extract a thumbnail, a 40um resolution image and the x16 pyramid, with the
+  # same compression as the pyramid made from the PNG below
+  ./process_raw_slide.py -m -i $svslocal -s ./data/${svs} --x16-compression deflate
 
 else
   echo "Raw SVS file not found for $id $svs"
   exit -1
 fi
 
-# Locate the tiff
-
-# Run VIPS
-MIDRES_PNG=./data/${svs}_x16.png
-MIDRES_TIFF=./data/${svs}_x16.tiff
-MIDRES_PTIFF=./data/${svs}_x16_pyramid.tiff
-convert $MIDRES_PNG $MIDRES_TIFF
-vips tiffsave $MIDRES_TIFF $MIDRES_PTIFF \
-  --vips-progress --compression=deflate \
-  --tile --tile-width=256 --tile-height=256 \
-  --pyramid --bigtiff
+# Run VIPS on the PNG, unless the pyramid was already made from the slide. Both
+# ways, the pyramid is deflate-compressed. VIPS reads the PNG directly, so there
+# is no need to convert it to TIFF first
+if [[ ! -f $MIDRES_PTIFF ]]; then
+  vips tiffsave $MIDRES_PNG $MIDRES_PTIFF \
+    --vips-progress --compression=deflate \
+    --tile --tile-width=256 --tile-height=256 \
+    --pyramid --bigtiff
+fi
 
 # Upload
 gsutil cp $MIDRES_PTIFF $PREPROCBASE/
@@ -8,6 +8,8 @@ import argparse
 import pyvips
 import SimpleITK as sitk
 import json
+import struct
+import tempfile
 
 # Little function to round numbers up to closest divisor of d
 def round_up(x, d):
@@ -45,6 +47,89 @@ def get_spacing(slide):
     return (sx, sy)
 
 
+# Find the pyramid level closest to x16 downsampling, without going coarser
+def find_x16_level(slide):
+    best_lev = 0
+    for lev in range(slide.level_count):
+      dsam=int(slide.level_downsamples[lev] + 0.5)
+      if dsam <= 16:
+        best_lev = lev
+    return best_lev
+
+
+# Get the background color of a slide as an RGB array. Transparent areas of the slide
+# are painted with this color, as in OpenSlide's get_thumbnail
+def get_background(slide):
+    bg = slide.properties.get('openslide.background-color', 'ffffff')
+    return np.array([int(bg[i:i+2], 16) for i in (0, 2, 4)], dtype=np.uint32)
+
+
+# Read a region of a level as an RGB array, compositing the RGBA image returned by
+# OpenSlide onto the background color
+def read_tile_rgb(slide, x, y, level, tw, th, bg):
+    ds = slide.level_downsamples[level]
+    tile = np.asarray(slide.read_region((int(x * ds), int(y * ds)), level, (tw, th))).astype(np.uint32)
+    a = tile[:,:,3:4]
+    return ((tile[:,:,0:3] * a + bg * (255 - a) + 127) // 255).astype(np.uint8)
+
+
+# Read a whole pyramid level into an RGB array, tile by tile, so that only one tile
+# is held as an RGBA image at a time
+def read_level_rgb(slide, level, tile_size=4096):
+    (w, h) = slide.level_dimensions[level]
+    bg = get_background(slide)
+    arr = np.empty((h, w, 3), dtype=np.uint8)
+    for y in range(0, h, tile_size):
+        for x in range(0, w, tile_size):
+            (tw, th) = (min(tile_size, w - x), min(tile_size, h - y))
+            arr[y:y+th, x:x+tw, :] = read_tile_rgb(slide, x, y, level, tw, th, bg)
+    return arr
+
+
+# Write a whole pyramid level to a file in the native vips format, tile by tile. The
+# file is a 64-byte header, the RGB pixels in rows, and an XML extension. Each row of a
+# tile is written at its place in the file with a regular write, so only one tile is
+# held in memory at a time and the file data does not count toward resident memory
+def write_level_vips(slide, level, fn_v, tile_size=4096):
+    (w, h) = slide.level_dimensions[level]
+    bg = get_background(slide)
+    header = struct.pack('>I', 0xb6a6f208) + struct.pack(
+        '<7i2fi2h2i', w, h, 3, 8, 0, 0, 22, 1.0, 1.0, 0, 0, 0, 0, 0)
+    with open(fn_v, 'wb') as f:
+        f.write(header.ljust(64, b'\0'))
+        for y in range(0, h, tile_size):
+            for x in range(0, w, tile_size):
+                (tw, th) = (min(tile_size, w - x), min(tile_size, h - y))
+                tile = read_tile_rgb(slide, x, y, level, tw, th, bg)
+                for r in range(th):
+                    f.seek(64 + ((y + r) * w + x) * 3)
+                    f.write(tile[r].tobytes())
+        f.seek(64 + w * h * 3)
+        f.write(b'<?xml version="1.0"?>\n<root xmlns="http://www.vips.ecs.soton.ac.uk/vips/8.8.0">'
+                b'<header></header><meta></meta></root>\n')
+
+
+# Read a whole pyramid level as a pyvips image. In memory mode the level is held in
+# RAM. In stream mode it is written tile by tile to a vips format file on disk. Unlike
+# a raw file loaded with rawload, which is mapped whole, vips maps such a file in
+# windows of the rows being processed, so peak memory does not depend on the size of
+# the slide. Returns the image and the file to delete when done (or None)
+def load_level_vips(slide, level, mode, tmpdir=None):
+    (w, h) = slide.level_dimensions[level]
+    if mode == 'memory':
+        arr = read_level_rgb(slide, level)
+        return pyvips.Image.new_from_memory(arr.reshape(h*w*3).data,w,h,3,'uchar'), None
+
+    (fd, fn_v) = tempfile.mkstemp(suffix='.v', dir=tmpdir)
+    os.close(fd)
+    try:
+        write_level_vips(slide, level, fn_v)
+        return pyvips.Image.new_from_file(fn_v), fn_v
+    except:
+        os.remove(fn_v)
+        raise
+
+
 # Main
 def main(argv):
 
@@ -58,6 +143,12 @@ def main(argv):
                         help='Include x16 outputs in the summary')
     parser.add_argument('-l', '--check-levels', action='store_true',
                         help='Print the number of levels in the input image')
+    parser.add_argument('--x16-mode', choices=['stream', 'memory'], default='stream',
+                        help='Hold the x16 level in memory, or stream it through a temporary '
+                             'file next to the summary outputs so that memory use is bounded')
+    parser.add_argument('--x16-compression', choices=['jpeg', 'deflate'], default='jpeg',
+                        help='Compression of the x16 pyramid: JPEG Q80, or lossless deflate with '
+                             '256x256 tiles as written by make_x16_pyramid.sh')
     args = parser.parse_args()
 
     # If only asking to see the number of levels, do that
@@ -75,71 +166,76 @@ def main(argv):
     # Read the slide first
     slide=openslide.OpenSlide(args.input)
 
-    # The simple thumbnail
-    img = slide.get_thumbnail((1000,1000))
-    img.save(args.summary + '_thumbnail.tiff')
-
-    # The NIFTI thumbnail with fixed resolution
-    (sx,sy) = get_spacing(slide)
-
-    # Determine the dimensions of the thumbnail to achieve desired
-    # resolution of 0.04x0.04mm
-    wx = round_up(slide.dimensions[0] * sx / 0.04, 1)
-    wy = round_up(slide.dimensions[1] * sy / 0.04, 1)
-
-    # Get the thumbnail from the image at this resolution
-    idata = np.asarray(slide.get_thumbnail((wx, wy)))
-    (wwx, wwy) = (idata.shape[1], idata.shape[0])
-
-    # Recompute the spacing using the actual size of image
-    ssx = (sx * slide.dimensions[0]) / wwx
-    ssy = (sy * slide.dimensions[1]) / wwy
-
-    # Save as a NIFTI
-    res = sitk.GetImageFromArray(idata, True)
-    res.SetSpacing((ssx, ssy))
-    sitk.WriteImage(res, args.summary + '_rgb_40um.nii.gz')
-
-    # Save dimensions info to a JSON file
-    with open(args.summary + "_metadata.json", "wt") as fp:
-        json.dump({
-            "dimensions": slide.dimensions,
-            "level_count": slide.level_count,
-            "level_dimensions": slide.level_dimensions,
-            "level_downsamples": slide.level_downsamples,
-            "spacing": (sx,sy) }, fp);
-
-    # Get the label
-    if 'label' in slide.associated_images:
-        img = slide.associated_images['label']
-        img.save(args.summary + '_label.tiff')
-
-    # Get the label
-    if 'macro' in slide.associated_images:
-        img = slide.associated_images['macro']
-        img.save(args.summary + '_macro.tiff')
-
-    if args.x16:
-
-        # Requested x16 middle-resolution image. The middle resolution images
-        # can be generated using openslide very easily
-        best_lev = 0
-        for lev in range(slide.level_count):
-          dsam=int(slide.level_downsamples[lev] + 0.5)
-          if dsam <= 16:
-            best_lev = lev
-
-        # Downsample at this level
-        image=slide.read_region((0,0), best_lev, slide.level_dimensions[best_lev])
-        image.save(args.summary + '_x16.png')
-        arr=np.array(image)
-
-        # Create a pyvips image
-        h,w,b = arr.shape
-        ivips = pyvips.Image.new_from_memory(arr.reshape(h*w*b).data,w,h,b,'uchar')
-        ivips.write_to_file(args.summary + '_x16_pyramid.tiff',
-                            Q=80, tile=True, compression='jpeg', 
-                            pyramid=True, bigtiff=True)
+    # All the images are derived from a single read of the level closest to x16, which
+    # is at least as fine as any of the images except the x16 image itself
+    best_lev = find_x16_level(slide)
+    ivips, fn_tmp = load_level_vips(slide, best_lev, args.x16_mode,
+                                    os.path.dirname(os.path.abspath(args.summary)))
+
+    # The temporary copy of the x16 level is removed even if a step fails
+    try:
+        # The simple thumbnail, fitting in a 1000x1000 box like OpenSlide's thumbnail, which
+        # is never enlarged
+        ivips.thumbnail_image(1000, height=1000, size='down').write_to_file(args.summary + '_thumbnail.tiff')
+
+        # The NIFTI thumbnail with fixed resolution
+        (sx,sy) = get_spacing(slide)
+
+        # Determine the dimensions of the thumbnail to achieve desired
+        # resolution of 0.04x0.04mm
+        wx = round_up(slide.dimensions[0] * sx / 0.04, 1)
+        wy = round_up(slide.dimensions[1] * sy / 0.04, 1)
+
+        # Get the thumbnail from the image at this resolution
+        ithumb = ivips.thumbnail_image(wx, height=wy, size='down')
+        idata = np.ndarray(buffer=ithumb.write_to_memory(), dtype=np.uint8,
+                           shape=(ithumb.height, ithumb.width, ithumb.bands))
+        (wwx, wwy) = (idata.shape[1], idata.shape[0])
+
+        # Recompute the spacing using the actual size of image
+        ssx = (sx * slide.dimensions[0]) / wwx
+        ssy = (sy * slide.dimensions[1]) / wwy
+
+        # Save as a NIFTI
+        res = sitk.GetImageFromArray(idata, True)
+        res.SetSpacing((ssx, ssy))
+        sitk.WriteImage(res, args.summary + '_rgb_40um.nii.gz')
+
+        # Save dimensions info to a JSON file
+        with open(args.summary + "_metadata.json", "wt") as fp:
+            json.dump({
+                "dimensions": slide.dimensions,
+                "level_count": slide.level_count,
+                "level_dimensions": slide.level_dimensions,
+                "level_downsamples": slide.level_downsamples,
+                "spacing": (sx,sy) }, fp);
+
+        # Get the label
+        if 'label' in slide.associated_images:
+            img = slide.associated_images['label']
+            img.save(args.summary + '_label.tiff')
+
+        # Get the label
+        if 'macro' in slide.associated_images:
+            img = slide.associated_images['macro']
+            img.save(args.summary + '_macro.tiff')
+
+        if args.x16:
+
+            # Requested x16 middle-resolution image, as a PNG and as a tiled pyramid
+            ivips.write_to_file(args.summary + '_x16.png')
+            if args.x16_compression == 'deflate':
+                ivips.write_to_file(args.summary + '_x16_pyramid.tiff',
+                                    tile=True, tile_width=256, tile_height=256, compression='deflate',
+                                    pyramid=True, bigtiff=True)
+            else:
+                ivips.write_to_file(args.summary + '_x16_pyramid.tiff',
+                                    Q=80, tile=True, compression='jpeg',
+                                    pyramid=True, bigtiff=True)
+
+    finally:
+        if fn_tmp is not None:
+            os.remove(fn_tmp)
 
 
 if __name__ == "__main__":
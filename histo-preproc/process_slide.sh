@@ -51,8 +51,10 @@ if [[ $LEVELS -le 1 ]]; then
   mv $svslocal ./data/fixflat
   svsflat=$(ls ./data/fixflat/${svs}.*)
 
-  # Write pyramid
-  if ! ./fixup_huron.py $svsflat $svslocal; then
+  # Write pyramid, so that later steps do not have to decode the full resolution
+  # image to read lower resolutions. Level 0 is stored losslessly, since the result
+  # replaces the raw slide
+  if ! python build_pyramid.py --verify $svsflat $svslocal; then
     echo "Failed to generate pyramid tif/svs"
     exit -1
   fi
@@ -4,126 +4,208 @@ import pandas as pd
 import argparse
 import os
 import json
-import nibabel as nib
-from scipy import signal
-
-# Create a parser
-parse = argparse.ArgumentParser(
-    description="Integrate inclusion density over HistoAnnot samples")
-
-# Add the arguments
-parse.add_argument('manifest', metavar='manifest', type=str,
-                   help="""
-                        sample manifest file, generated on HistoAnnot server using command
-                        flask samples-export-csv <task> manifest.csv --ids --specimen --header
-                        """)
-parse.add_argument('datadir', metavar='datadir', type=str,
-                   help='Directory containing density files')
-
-parse.add_argument('result', metavar='result', type=str,
-                   help='Output CSV file')
-
-parse.add_argument('--stain', metavar='stain', type=str, default='Tau',
-                   help="Name of the stain analyzed")
-
-parse.add_argument('--model', metavar='model', type=str, default='tangles',
-                   help="Name of the CNN model analyzed")
-
-parse.add_argument('--mean-filter-size', metavar='N', type=int, default=512,
-                   help="Size of the mean filter, in raw histology image pixels")
-
-# Parse the arguments
-args = parse.parse_args()
-
-# Parse the CSV file
-df = pd.read_csv(args.manifest)
-
-# Keep track of current nifti image and current slide
-curr_slide, curr_nii, curr_bm, curr_mf = None, None, None, None
-
-# Output dictionary
-res = {
-    'id': [],
-    'specimen': [],
-    'block': [],
-    'slide_name': [],
-    'label': [],
-    'mean_burden': [],
-    'max_sliding_burden': []
-}
-
-# Iterate over all samples
-for index, row in df.iterrows():
-
-    # Check the stain
-    if row['stain'] != args.stain:
-        continue
+import multiprocessing
+import tempfile
+import itertools
+from density_map_cache import open_density_cache, open_density_map, read_density_region
+from burden_stats import integral_image, roi_burden
+
+# The burden contrasts to compute, as (stain, model, contrast, weights, softmax). With
+# a density_param.json file, these are all the contrasts of all the models of all the
+# stains in the file, in the order jq lists them in recon.sh. Otherwise there is one
+# contrast, the difference between the two classes
+def read_contrasts(args):
+    if args.density_param is None:
+        return [(args.stain, args.model, 'burden', [-1.0, 1.0], 0.0)]
+    with open(args.density_param, 'rt') as f_json:
+        param = json.load(f_json)
+    return [(stain, model, contrast, [float(w) for w in c['weights']], float(c.get('softmax') or 0))
+            for stain in sorted(param)
+            for model in sorted(param[stain].get('models', {}))
+            for (contrast, c) in sorted(param[stain]['models'][model].get('contrasts', {}).items())]
+
+# Burden map of a contrast from an array whose last axis holds the classes of a density
+# map, computed like splat_density in recon.sh (c2d -mcs map [-scale S -softmax] -wsum
+# weights -clip 0 inf). As in c2d, the scale only applies to the last class, before the
+# softmax over the classes
+def contrast_map(roi, weights, softmax):
+    if softmax:
+        roi = roi.copy()
+        roi[...,-1] *= softmax
+        e = np.exp(roi - np.max(roi, axis=-1, keepdims=True))
+        roi = e / np.sum(e, axis=-1, keepdims=True)
+    bm = np.dot(roi, weights)
+    bm[bm < 0.0] = 0.0
+    return bm
+
+# State of a worker process: the parsed arguments and the cache of decompressed density
+# maps. Open maps are not kept across slides, since each map belongs to a single slide
+# and each slide is processed once
+worker_args, density_cache = None, None
+
+def worker_init(args):
+    global worker_args, density_cache
+    worker_args = args
+    density_cache = open_density_cache(args.cache_dir, args.cache_max_gb)
+
+# Compute the burden statistics of all samples on one slide, for each contrast. Returns
+# a list of the position of each sample in the manifest, the index of the contrast and
+# the row in the output
+def process_slide(group):
+    args = worker_args
+    ((specimen, slide), rows) = group
 
     # Find the json descriptor
     fn_json=os.path.join(args.datadir, '%s/histo_proc/%s/preproc/%s_metadata.json' %
-                         (row['specimen_name'], row['slide_name'], row['slide_name']))
-
-    # Find the nifti file
-    fn_nii=os.path.join(args.datadir, '%s/histo_proc/%s/density/%s_%s_%s_densitymap.nii.gz' %
-                         (row['specimen_name'], row['slide_name'], row['slide_name'],
-                          args.stain, args.model))
+                         (specimen, slide, slide))
 
     if not os.path.isfile(fn_json):
         print('Missing file ', fn_json)
-        continue
-
-    if not os.path.isfile(fn_nii):
-        print('Missing file ', fn_nii)
-        continue
+        return []
 
-    # Load the json file
+    # Load the json file, once for all samples on the slide
     with open(fn_json,'rt') as f_json:
         metadata = json.load(f_json)
 
-        # Load the nifti file
-        if curr_slide != row['slide_name']:
-            # Load slide
-            curr_slide = row['slide_name']
-            curr_nii = nib.load(fn_nii)
-
-            # Compute burden map
-            curr_bm = curr_nii.get_fdata()[:,:,0,0,1] - curr_nii.get_fdata()[:,:,0,0,0]
-            curr_bm[curr_bm < 0.0] = 0.0
-            curr_mf = None
-
-        # The the index and size of current sample
-        sx = curr_nii.shape[0] * 1.0 / metadata['dimensions'][0]
-        sy = curr_nii.shape[1] * 1.0 / metadata['dimensions'][1]
+    # Each density map (stain and model) is read once for all of its contrasts
+    result = []
+    for ((stain, model), contrasts) in itertools.groupby(enumerate(args.contrasts), lambda c: c[1][0:2]):
+        contrasts = list(contrasts)
+        stain_rows = [(order, row) for (order, row) in rows if row['stain'] == stain]
+        if len(stain_rows) == 0:
+            continue
 
-        # Get the nifti dimensions and scaling factor
-        nx, ny = int(sx * row['x'] + 0.5), int(sy * row['y'] + 0.5)
-        nw, nh = int(sx * row['w'] + 0.5), int(sy * row['h'] + 0.5)
+        # Find the nifti file
+        fn_nii=os.path.join(args.datadir, '%s/histo_proc/%s/density/%s_%s_%s_densitymap.nii.gz' %
+                             (specimen, slide, slide, stain, model))
 
-        # Extract the relevant chunk
-        roi = curr_bm[nx:nx+nw,ny:ny+nh]
+        if not os.path.isfile(fn_nii):
+            print('Missing file ', fn_nii)
+            continue
 
-        # Calculate the mean burden
-        burden=np.mean(roi)
+        # Open the density map, which is only read in the sample boxes
+        nii = open_density_map(density_cache, fn_nii)
+        shape = nii['shape']
 
-        # Calculate the max sliding window burden
+        # The the index and size of current sample
+        sx = shape[0] * 1.0 / metadata['dimensions'][0]
+        sy = shape[1] * 1.0 / metadata['dimensions'][1]
         fx, fy = int(sx * args.mean_filter_size + 0.5), int(sy * args.mean_filter_size + 0.5)
-        kernel = np.full((fx, fy), 1.0 / (fx * fy))
-        max_sliding=np.amax(
-            signal.convolve(roi, kernel, mode='same') / signal.convolve(np.ones(roi.shape), kernel, mode='same'))
-
-        # Print details in a report
-        res['id'].append(row['id'])
-        res['specimen'].append(row['specimen_name'])
-        res['block'].append(row['block_name'])
-        res['slide_name'].append(row['slide_name'])
-        res['label'].append(row['label_name'])
-        res['mean_burden'].append(burden)
-        res['max_sliding_burden'].append(max_sliding)
-
-        print('%s\t%s\t%d,%d,%d,%d\t%6.4f\t%6.4f' %
-              (row['slide_name'], row['label_name'], nx, ny, nw, nh, burden, max_sliding))
-
-# Export the dataframe as CSV
-pd.DataFrame(res).to_csv(args.result)
-
 
+        for (order, row) in stain_rows:
+
+            # Get the nifti dimensions and scaling factor
+            nx, ny = int(sx * row['x'] + 0.5), int(sy * row['y'] + 0.5)
+            nw, nh = int(sx * row['w'] + 0.5), int(sy * row['h'] + 0.5)
+            roi = read_density_region(nii, nx, ny, nw, nh)
+
+            for (k, (_, _, contrast, weights, softmax)) in contrasts:
+
+                # Calculate the mean burden and the max sliding window burden. The sliding
+                # window is clipped to the box, so the integral image of the box is enough
+                sat = integral_image(contrast_map(roi, weights, softmax))
+                burden, max_sliding = roi_burden(sat, 0, 0, nw, nh, fx, fy)
+
+                # Print details in a report
+                result.append((order, k, {
+                    'id': row['id'],
+                    'specimen': row['specimen_name'],
+                    'block': row['block_name'],
+                    'slide_name': row['slide_name'],
+                    'label': row['label_name'],
+                    'stain': stain,
+                    'model': model,
+                    'contrast': contrast,
+                    'mean_burden': burden,
+                    'max_sliding_burden': max_sliding }))
+
+                print('%s\t%s\t%s\t%d,%d,%d,%d\t%6.4f\t%6.4f' %
+                      (row['slide_name'], row['label_name'], contrast, nx, ny, nw, nh, burden, max_sliding))
+
+    return result
+
+def main():
+
+    # Create a parser
+    parse = argparse.ArgumentParser(
+        description="Integrate inclusion density over HistoAnnot samples")
+
+    # Add the arguments
+    parse.add_argument('manifest', metavar='manifest', type=str,
+                       help="""
+                            sample manifest file, generated on HistoAnnot server using command
+                            flask samples-export-csv <task> manifest.csv --ids --specimen --header
+                            """)
+    parse.add_argument('datadir', metavar='datadir', type=str,
+                       help='Directory containing density files')
+
+    parse.add_argument('result', metavar='result', type=str,
+                       help='Output CSV file. With --density-param, the output is in long format '
+                            'and written as Parquet or Feather if the name ends in .parquet or .feather')
+
+    parse.add_argument('--stain', metavar='stain', type=str, default='Tau',
+                       help="Name of the stain analyzed")
+
+    parse.add_argument('--model', metavar='model', type=str, default='tangles',
+                       help="Name of the CNN model analyzed")
+
+    parse.add_argument('--density-param', metavar='json', type=str,
+                       help="Compute all the contrasts of all the models and stains in this "
+                            "density_param.json file in one pass, instead of --stain and --model")
+
+    parse.add_argument('--mean-filter-size', metavar='N', type=int, default=512,
+                       help="Size of the mean filter, in raw histology image pixels")
+
+    parse.add_argument('--jobs', metavar='N', type=int, default=min(4, multiprocessing.cpu_count()),
+                       help="Number of slides processed in parallel. Each process holds the sample "
+                            "boxes of one slide at a time (default: 4, or fewer CPUs)")
+
+    parse.add_argument('--cache-dir', metavar='dir', type=str,
+                       default=os.path.join(tempfile.gettempdir(), 'density_map_cache'),
+                       help="Directory where density maps are kept decompressed for region reads")
+
+    parse.add_argument('--cache-max-gb', metavar='GB', type=float, default=20.0,
+                       help="Maximum size of the decompressed density map cache")
+
+    # Parse the arguments
+    args = parse.parse_args()
+
+    # Parse the CSV file, keeping the samples of the stains analyzed
+    args.contrasts = read_contrasts(args)
+    df = pd.read_csv(args.manifest)
+    df = df[df['stain'].isin(set(c[0] for c in args.contrasts))]
+
+    # Group the samples by slide, so that each density map is loaded once. The position
+    # of each sample in the manifest is kept so the output follows the manifest order
+    df = df.assign(_order=np.arange(len(df)))
+    groups = [(key, list(zip(grp['_order'], grp.to_dict('records'))))
+              for (key, grp) in df.groupby(['specimen_name', 'slide_name'], sort=False)]
+
+    # Process the slides in a pool of worker processes
+    result = []
+    if args.jobs > 1:
+        with multiprocessing.Pool(args.jobs, initializer=worker_init, initargs=(args,)) as pool:
+            for group_result in pool.imap_unordered(process_slide, groups):
+                result.extend(group_result)
+    else:
+        worker_init(args)
+        for group in groups:
+            result.extend(process_slide(group))
+
+    # Export the dataframe in manifest order, and then in the order of the contrasts
+    result.sort(key=lambda r: r[0:2])
+    columns = ['id', 'specimen', 'block', 'slide_name', 'label', 'mean_burden', 'max_sliding_burden']
+    if args.density_param is None:
+        pd.DataFrame([r for (_, _, r) in result], columns=columns).to_csv(args.result)
+    else:
+        columns[5:5] = ['stain', 'model', 'contrast']
+        res = pd.DataFrame([r for (_, _, r) in result], columns=columns)
+        if args.result.endswith('.parquet'):
+            res.to_parquet(args.result, index=False)
+        elif args.result.endswith('.feather'):
+            res.to_feather(args.result)
+        else:
+            res.to_csv(args.result, index=False)
+
+if __name__ == '__main__':
+    main()
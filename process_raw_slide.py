@@ -5,6 +5,9 @@ import numpy as np
 import os, time, math, sys
 import getopt
 import parse
+import multiprocessing
+import functools
+from tiled_filter import iter_tiled_filter
 import SimpleITK as sitk
 
 # Little function to round numbers up to closest divisor of d
@@ -17,6 +20,43 @@ def tile_means(img, tile_size):
     c=np.mean(b.reshape(-1,tile_size,b.shape[1]),axis=1)
     return c
 
+# Means of image tiles for a chunk that is clipped to the edge of the slide. Tiles
+# that are partly outside of the slide average the pixels inside
+def tile_means_valid(img, tile_size):
+    (ny, nx) = img.shape
+    s = np.zeros((round_up(ny, tile_size), round_up(nx, tile_size)), dtype=np.float32)
+    w = np.zeros(s.shape, dtype=np.float32)
+    s[0:ny,0:nx] = img
+    w[0:ny,0:nx] = 1.0
+    return tile_means(s, tile_size) / tile_means(w, tile_size)
+
+# Stain matrix stuff
+stain_mat = np.array([
+    [ 0.6443186, 0.7166757, 0.26688856],
+    [0.09283128, 0.9545457, 0.28324] ,
+    [0.63595444, 0.001, 0.7717266]])
+stain_mat_inv = np.linalg.inv(stain_mat)
+
+# Hematoxylin channel of the color deconvolution, in float32
+hemo_vec = stain_mat_inv[1,].astype(np.float32)
+
+# Lookup table of -log((v+1)/256) for 8-bit values, so the log is not evaluated per pixel
+neg_log_lut = (-np.log((np.arange(256, dtype=np.float64) + 1.) / 256.0)).astype(np.float32)
+
+# Read a region of the slide and compute the hematoxylin channel of the color deconvolution
+def read_hemo(slide, x, y, w, h):
+    reg=np.array(slide.read_region((x,y), 0, (w,h)))[:,:,0:3]
+    return 1 - np.dot(neg_log_lut[reg], hemo_vec)
+
+# Radius of the dilation, which is the halo needed around each chunk
+dilate_radius = 6
+
+# ITK math morphology
+def dilate_hemo(img):
+    return sitk.GetArrayFromImage(
+        sitk.GrayscaleDilate(
+            sitk.GetImageFromArray(img, False), dilate_radius))
+
 # Main function
 def process_svs(p):
 
@@ -61,8 +101,8 @@ def process_svs(p):
         print("Spacing of the mri-like image: %gx%gmm\n" % (sx, sy))
 
         # Allocate output image
-        (ox,oy)=(wx/tile_size, wy/tile_size)
-        oimg=np.zeros([oy,ox])
+        (ox,oy)=(wx//tile_size, wy//tile_size)
+        oimg=np.zeros([oy,ox], dtype=np.float32)
 
         # Set the chunk size in pixels and the chunk arrays
         chunk_tiles=40
@@ -70,40 +110,23 @@ def process_svs(p):
         px = np.arange(0,round_up(slide.dimensions[0],chunk_size), chunk_size)
         py = np.arange(0,round_up(slide.dimensions[1],chunk_size), chunk_size)
 
-        # Stain matrix stuff
-        stain_mat = np.array([
-            [ 0.6443186, 0.7166757, 0.26688856],
-            [0.09283128, 0.9545457, 0.28324] ,
-            [0.63595444, 0.001, 0.7717266]])
-        stain_mat_inv = np.linalg.inv(stain_mat)
-
-        # Loop over the chunks
-        for ix in px:
-            for iy in py:
-
-                # Read the region and convert to NUMPY
-                reg=np.array(slide.read_region((ix,iy), 0, (chunk_size,chunk_size)))[:,:,0:3]
-                
-                # Color deconvolution
-                reg_hemo=1 - np.dot(-np.log((reg+1.) / 256.0), stain_mat_inv[1,])
-                
-                # ITK math morphology
-                reg_mm=sitk.GetArrayFromImage(
-                    sitk.GrayscaleDilate(
-                        sitk.GetImageFromArray(reg_hemo, False), 6));
-                
-                # Reduce to a small image
-                a=tile_means(reg_mm,tile_size)
-                
-                # Fill the corresponding region of the output image
-                (qx,qy) = (ix/tile_size,iy/tile_size)
-                (zx,zy) = (min(ox-qx,chunk_tiles), min(oy-qy,chunk_tiles))    
-                oimg[qy:qy+zy,qx:qx+zx]=a[0:zy,0:zx]
-
-                # Print progress
-                sys.stdout.write('\rChunk (%03d,%03d)' % (ix,iy))
-                sys.stdout.flush()
-                
+        # Process the chunks in a pool of worker processes, and place each result
+        # in the output image as it arrives. Chunks are read with a halo for the
+        # dilation, so there are no seams between chunks
+        n_chunks = len(px) * len(py)
+        for (k, ((ix,iy,_,_), a)) in enumerate(iter_tiled_filter(
+                openslide.OpenSlide, (p['in_img'],), read_hemo, dilate_hemo, slide.dimensions,
+                chunk_size, dilate_radius, functools.partial(tile_means_valid, tile_size=tile_size),
+                p['workers'])):
+
+            # Fill the corresponding region of the output image
+            (qx,qy) = (ix//tile_size,iy//tile_size)
+            (zx,zy) = (min(ox-qx,chunk_tiles), min(oy-qy,chunk_tiles))
+            oimg[qy:qy+zy,qx:qx+zx]=a[0:zy,0:zx]
+
+            # Print progress
+            sys.stdout.write('\rChunk (%03d,%03d) %d/%d' % (ix,iy,k+1,n_chunks))
+            sys.stdout.flush()
 
 
         # Write the result as a NIFTI file
@@ -131,7 +154,7 @@ def process_svs(p):
 
 # Usage
 def usage(exit_code):
-    print('process_raw_slide -i <input_svs> -o <output> -m <out_x16> [-t tile_size]')
+    print('process_raw_slide -i <input_svs> -o <output> -m <out_x16> [-t tile_size] [-j workers]')
     sys.exit(exit_code)
     
 # Main
@@ -141,11 +164,12 @@ def main(argv):
          'out_img' : '', 
          'summary' : '',
          'out_x16' : '',
-         'tile_size' : 100}
+         'tile_size' : 100,
+         'workers' : multiprocessing.cpu_count()}
 
     # Read options
     try:
-        opts, args = getopt.getopt(argv, "hi:o:t:s:m:")
+        opts, args = getopt.getopt(argv, "hi:o:t:s:m:j:")
     except getopt.GetoptError:
         usage(2)
 
@@ -162,6 +186,8 @@ def main(argv):
             p['out_x16'] = arg
         elif opt == '-t':
             p['tile_size'] = int(arg)
+        elif opt == '-j':
+            p['workers'] = int(arg)
 
     # Run the main code
     process_svs(p)
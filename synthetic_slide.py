@@ -0,0 +1,30 @@
+#!/usr/bin/env python
+# Generate a synthetic tiled pyramidal TIFF that OpenSlide can read, for benchmarks
+# that must run offline (histo-burden/wildcat_bench.py, histo-preproc/bench_x16.py).
+# Tissue is simulated by smooth random blobs of stain-like color on a white background,
+# with noise for texture, so that the slide compresses like a real one and has glass
+from __future__ import print_function
+import numpy as np
+import pyvips
+
+# Write the slide. The pixel size (mpp) is in microns, and is stored in the resolution
+# tags, which OpenSlide reports as tiff.XResolution etc.
+def make_synthetic_slide(filename, width, height, mpp, seed=0):
+
+    # Low resolution tissue mask, made by thresholding smoothed noise
+    rng = np.random.RandomState(seed)
+    ds = 64
+    lw, lh = width // ds + 1, height // ds + 1
+    noise = pyvips.Image.new_from_memory(rng.rand(lh, lw).astype(np.float32).tobytes(), lw, lh, 1, 'float')
+    tissue = (noise.gaussblur(4) > 0.5).ifthenelse(1.0, 0.0).resize(ds, kernel='linear').crop(0, 0, width, height)
+
+    # Color the tissue and add texture
+    glass = pyvips.Image.black(width, height, bands=3) + [240, 240, 238]
+    stain = pyvips.Image.black(width, height, bands=3) + [150, 90, 160]
+    texture = pyvips.Image.gaussnoise(width, height, sigma=25, mean=0)
+    img = (glass * (1 - tissue) + (stain + texture) * tissue).cast('uchar')
+
+    # Write as a tiled pyramid. Resolution is given in pixels per cm
+    img.tiffsave(filename, tile=True, tile_width=256, tile_height=256, pyramid=True,
+                 compression='jpeg', Q=85, bigtiff=True, resunit='cm',
+                 xres=1000.0 / mpp, yres=1000.0 / mpp)
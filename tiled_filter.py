@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# Apply a neighbourhood filter (e.g., grayscale morphology) to an image too large to
+# hold in memory, such as a whole slide, in chunks processed in parallel. Each chunk
+# is read with a halo of at least the filter radius, and the halo is cropped after
+# filtering. Chunks are clipped to the image and the halo only extends into the image,
+# so the filter sees the same image boundary as when applied to the whole image at
+# once, and the result does not depend on the chunk size
+from __future__ import print_function
+import multiprocessing
+import numpy as np
+
+# Split an image of the given (x,y) size into chunks (x,y,w,h). Chunks on the right
+# and bottom edges are clipped to the image
+def chunk_grid(image_size, chunk_size):
+    (nx, ny) = image_size
+    return [(x, y, min(chunk_size, nx - x), min(chunk_size, ny - y))
+            for x in range(0, nx, chunk_size) for y in range(0, ny, chunk_size)]
+
+# Filter a single chunk. The source is read over the chunk plus the halo (within the
+# image), filtered, and the halo is cropped. The optional reduce function is applied
+# to the cropped result, e.g., to compute tile statistics, so that only the reduced
+# result is sent back from a worker
+def filter_chunk(source, read_fn, filter_fn, reduce_fn, image_size, halo, box):
+    (x, y, w, h) = box
+    x0, y0 = max(0, x - halo), max(0, y - halo)
+    x1, y1 = min(image_size[0], x + w + halo), min(image_size[1], y + h + halo)
+    data = filter_fn(read_fn(source, x0, y0, x1 - x0, y1 - y0))
+    data = data[y-y0:y-y0+h, x-x0:x-x0+w]
+    return data if reduce_fn is None else reduce_fn(data)
+
+# State of a worker process. The source (e.g., an OpenSlide handle) is opened in each
+# process because handles cannot be shared across processes
+tiled_filter_state = None
+
+def tiled_filter_init(open_fn, open_args, read_fn, filter_fn, reduce_fn, image_size, halo):
+    global tiled_filter_state
+    tiled_filter_state = (open_fn(*open_args), read_fn, filter_fn, reduce_fn, image_size, halo)
+
+def tiled_filter_run(box):
+    return box, filter_chunk(*(tiled_filter_state + (box,)))
+
+# Generate (box, result) for each chunk of the image, in the order in which they are
+# completed. The functions must be defined at module level so they can be sent to the
+# worker processes:
+#   open_fn(*open_args)              opens the source
+#   read_fn(source, x, y, w, h)      reads a region as a YxX[xC] array
+#   filter_fn(data)                  filters a region, returning a YxX array
+#   reduce_fn(data)                  optionally reduces the filtered chunk
+# With workers=0, chunks are processed in the calling process
+def iter_tiled_filter(open_fn, open_args, read_fn, filter_fn, image_size, chunk_size, halo,
+                      reduce_fn=None, workers=None):
+    boxes = chunk_grid(image_size, chunk_size)
+    init_args = (open_fn, open_args, read_fn, filter_fn, reduce_fn, image_size, halo)
+    if workers == 0:
+        tiled_filter_init(*init_args)
+        for box in boxes:
+            yield tiled_filter_run(box)
+        return
+
+    pool = multiprocessing.Pool(workers, initializer=tiled_filter_init, initargs=init_args)
+    try:
+        for result in pool.imap_unordered(tiled_filter_run, boxes):
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+# Filter the whole image into an output array (which may be memory-mapped), writing
+# each chunk in place as it is completed
+def apply_tiled_filter(open_fn, open_args, read_fn, filter_fn, image_size, chunk_size, halo,
+                       out=None, workers=None):
+    if out is None:
+        out = np.zeros((image_size[1], image_size[0]), dtype=np.float32)
+    for ((x, y, w, h), data) in iter_tiled_filter(open_fn, open_args, read_fn, filter_fn,
+                                                  image_size, chunk_size, halo, workers=workers):
+        out[y:y+h, x:x+w] = data
+    return out